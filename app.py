@@ -4,11 +4,18 @@ import subprocess
 import argparse
 
 from utils.couch_db_handler import CouchDBHandler
+from utils.document_store import DocumentStore
+from utils.history_writer import HistoryWriter
+from utils.model_downloader import ModelDownloader
+from utils.request_scheduler import AdmissionError, RequestScheduler
+from utils.resource_scheduler import ResourceScheduler
+from utils.task_plan import TaskPlanCompiler
 from utils.text_editor import Editor
 
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
-from fastapi import FastAPI, HTTPException, Body
-from typing import List, Annotated
+from fastapi import FastAPI, HTTPException, Body, Header
+from typing import Callable, List, Annotated, Optional
 
 
 DESCRIPTION = """
@@ -16,13 +23,21 @@ AI-NER let's you anonymize your text documents by using a model of your choice f
 
 ## Configuration of AI-NER
 Before you can anonymize your text documents, you have to add (or update) a configuration for a model and tasks.
-* `/insert_model`: Adds or updates a configuration for the models. It automatically downloads new models from huggingface.
+* `/insert_model`: Adds or updates a configuration for the models. It automatically downloads new models from huggingface
+in the background; the configuration is available once `/get_model_downloads` reports the download as complete.
 * `/insert_tasks`: Adds or updates a configuration for a tasks. You have to choose here which model you want to use for each task.
 
 ## Usage of AI-NER
 After you have configured models and tasks, you can anonymize your text documents in two steps:
 1. Run the `/set_tasks` route to let the text editor know which configs you want to choose.
 2. Send your text document via `/anonymize` to the text editor.
+
+Documents that are edited and re-sent repeatedly can be sent via `/anonymize_incremental` together with a document id.
+Only the sentences that changed since the last version are then run through the models.
+
+Requests are processed one after another, interactive requests before bulk requests and shorter before longer ones.
+A deadline can be set via the `X-Deadline-Ms` header or the `deadline_ms` field, the priority (`interactive` or `bulk`)
+via the `X-Priority` header or the `priority` field. Requests that can't meet their deadline are rejected with 503.
 """
 
 class Config(BaseModel):
@@ -32,72 +47,184 @@ class Config(BaseModel):
 
 class Text(BaseModel):
     input_text: str
+    deadline_ms: Optional[int] = None
+    priority: Optional[str] = None
 
 
 class Texts(BaseModel):
     input_text: List[str]
+    deadline_ms: Optional[int] = None
+    priority: Optional[str] = None
+
+
+class Document(BaseModel):
+    document_id: str
+    input_text: str
+    deadline_ms: Optional[int] = None
+    priority: Optional[str] = None
 
 
 class App:
-    def __init__(self, ip: str = "127.0.0.1", port: int = 8000, debug: bool = False) -> None:
+    def __init__(self, ip: str = "127.0.0.1", port: int = 8000, debug: bool = False,
+                 history_level: str = None, history_file: str = "data/history/history.jsonl.gz",
+                 model_server: str = None, language_granularity: str = "document") -> None:
         """
         Builds the App Object for the Server Backend
 
         :param ip: ip to serve
         :param port: port to serve
+        :param debug: if True and no history level is given, the full history of every request is recorded
+        :param history_level: history level of the text editor ("off", "patterns" or "full")
+        :param history_file: compressed JSONL file the history is written to
+        :param model_server: path of the Unix socket of a model server (see utils/model_server.py).
+                             If given, the models are not loaded in this process.
+        :param language_granularity: "document" or "paragraph", the level on which the language of a text is detected
+                                     for tasks with a `languages` filter
         """
         self._ip = ip
         self._port = port
         self._debug = debug
+        self._history_level = history_level or ("full" if debug else "off")
+        self._language_granularity = language_granularity
         self._app = FastAPI(
             title="AI-NER: Text editing with Language Models from Huggingface 🤗",
-            description=DESCRIPTION
+            description=DESCRIPTION,
+            lifespan=self.lifespan
         )
         self._task_db = CouchDBHandler("config_tasks")
         self._model_db = CouchDBHandler("config_models")
+        self._scheduler = ResourceScheduler()
+        self._plan_compiler = TaskPlanCompiler(self._model_db, self._scheduler, model_server,
+                                               with_responses=self._history_level == "full")
+        self._document_store = DocumentStore()
+        self._downloader = ModelDownloader()
+        self._request_scheduler = RequestScheduler()
+        self._history_writer = None
+        if self._history_level != "off":
+            self._history_writer = HistoryWriter(history_file)
         self._text_editor = None #Editor("config_task/default_task.yaml", self._model_db)
         
         self._configure_routes()
 
+    @asynccontextmanager
+    async def lifespan(self, app: FastAPI):
+        """
+        Lifespan of the api, flushes the pending history records on shutdown.
+
+        :param app: the FastAPI app
+        :return: None
+        """
+        yield
+        if self._history_writer is not None:
+            self._history_writer.close()
+
     @staticmethod
-    def modify_config(configs: List[Config], model_db: CouchDBHandler):
+    def modify_config(configs: List[Config], model_db: CouchDBHandler,
+                      downloader: ModelDownloader = None) -> dict:
         """
         Helper function to modify configs in the couchDB for either the tasks or the models.
         configs are either updated or added (if they dont exist yet).
+        Model configs with a link to a model file that does not exist yet are only added once the file is downloaded
+        (in the background) and verified against the optional `sha256` of the config.
 
         :param configs: List of configurations
         :param model_db: the handler for the DB
-        :return: None
+        :param downloader: downloader for the model files
+        :return: status per config ("complete", the status of the download or "rejected" if another file is
+                 already being downloaded for the config)
         """
         config_dict = {config.config_name: config.config_dict for config in configs}
-        all_config_names = model_db.get_all_config_names()
+        status = dict()
         for key, value in config_dict.items():
-            if "link" in value and not os.path.exists(value["model"]):
-                model_dir = "/".join(value["model"].split("/")[:-1])
-                subprocess.call(f"mkdir -p {model_dir}", shell=True)
-                subprocess.call(f"wget {value['link']} -P {model_dir}", shell=True)
-                value.pop("link")
-            elif "link" in value:
-                value.pop("link")
-
-            method = "add_config" if key not in all_config_names else "update_config"
-            getattr(model_db, method)(value, key)
-
-    def set_tasks(self, configuration: List[str]) -> bool:
+            link = value.pop("link", None)
+            sha256 = value.pop("sha256", None)
+
+            def register(value=value, key=key):
+                method = "add_config" if key not in model_db.get_all_config_names() else "update_config"
+                getattr(model_db, method)(value, key)
+
+            if link is not None and downloader is not None and not os.path.exists(value["model"]):
+                status[key] = downloader.submit(key, link, value["model"], sha256, on_complete=register)
+            else:
+                register()
+                status[key] = {"status": "complete"}
+
+        return status
+
+    def load_task_configs(self, configuration: List[str]) -> dict:
             """
-            Updates the text editor with configured tasks (and models) from the couchdb.
+            Loads the configs of the tasks from the couchdb.
 
-            :param configuration: List of configured tasks to be run by the editor \n
-            :return: True if successfully set all tasks
+            :param configuration: List of configured tasks \n
+            :return: dictionary of task name -> task config
             """
             config_dict = dict()
             for config in configuration:
                 config_dict[config] = self._task_db.get_config(config)
+            return config_dict
 
-            self._text_editor = Editor(config_dict, self._model_db)
+    def set_tasks(self, configuration: List[str], config_dict: Optional[dict] = None) -> bool:
+            """
+            Updates the text editor with configured tasks (and models) from the couchdb.
+            The tasks are compiled into an execution plan, which is cached as long as the configs don't change.
+
+            :param configuration: List of configured tasks to be run by the editor \n
+            :param config_dict: the already loaded task configs (loaded from the couchdb if None) \n
+            :return: True if successfully set all tasks
+            """
+            if config_dict is None:
+                config_dict = self.load_task_configs(configuration)
+
+            try:
+                plan = self._plan_compiler.compile(config_dict)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid task configuration: {e}")
+
+            self._text_editor = Editor(plan, self._model_db, self._scheduler,
+                                       self._history_level, self._history_writer,
+                                       language_granularity=self._language_granularity)
 
             return True
 
+    async def schedule(self, configuration: List[str], input_texts: List[str], edit: Callable,
+                       priority: str, deadline_ms: Optional[int], num_chars: Optional[int] = None,
+                       config_dict: Optional[dict] = None):
+        """
+        Runs an editing job through the request scheduler.
+        The job sets the tasks, runs the edit function and reports the measured task latencies to the scheduler.
+
+        :param configuration: List of configured tasks to be run
+        :param input_texts: Texts that are edited by the job (to estimate its runtime)
+        :param edit: function editing the texts with the text editor
+        :param priority: "interactive" or "bulk"
+        :param deadline_ms: time in milliseconds within which the request has to be answered
+        :param num_chars: number of characters the tasks run on, if not all of the input texts
+                          (e.g. only the changed sentences of an incremental edit)
+        :param config_dict: the already loaded task configs (loaded by the job if None)
+        :return: result of the edit function
+        """
+        if any(input_text is None or len(input_text) == 0 for input_text in input_texts) or len(input_texts) == 0:
+            raise HTTPException(status_code=400, detail="No value provided")
+        if priority not in RequestScheduler.PRIORITIES:
+            raise HTTPException(status_code=400, detail=f"Unknown priority {priority}")
+
+        def job():
+            tasks_set = self.set_tasks(configuration, config_dict)
+            if not tasks_set:
+                raise HTTPException(status_code=400, detail="Tasks configurations were not set correctly")
+            result = edit()
+            self._request_scheduler.observe(self._text_editor.pop_task_latencies())
+            return result
+
+        if num_chars is None:
+            num_chars = sum(map(len, input_texts))
+        cost = self._request_scheduler.estimate(configuration, num_chars)
+        try:
+            return await self._request_scheduler.submit(job, cost, priority, deadline_ms,
+                                                        self._request_scheduler.observed(configuration))
+        except AdmissionError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+
     def _configure_routes(self) -> None:
         """
         Creates the route(s)
@@ -127,16 +254,26 @@ class App:
                 },
             ]]
         )]
-        ) -> bool:
+        ) -> dict:
             """
             Inserts model configs into the couchdb.
             If a configuration under the name already exists, the configuration will be overwritten.
+            Model files given by a link are downloaded in the background, the config is only inserted once
+            the download is complete. The progress can be followed via `/get_model_downloads`.
 
             :param configs: Object consisting of the config name and config details \n
-            :return: True if everything went successful
+            :return: Status of each config
             """
-            self.modify_config(configs, self._model_db)
-            return True
+            return self.modify_config(configs, self._model_db, self._downloader)
+
+        @self._app.get("/get_model_downloads")
+        async def get_model_downloads() -> dict:
+            """
+            Returns the status of all model downloads started via `/insert_models`.
+
+            :return: Dictionary of config name -> status ("pending", "downloading", "complete" or "failed")
+            """
+            return self._downloader.status()
 
         @self._app.post("/delete_models")
         async def delete_models(config_names: List[str]) -> bool:
@@ -151,6 +288,7 @@ class App:
                 config = self._model_db.get_config(config_name)
                 subprocess.call(f"rm {config['model']}", shell=True)
                 self._model_db.delete_config(config_name)
+                self._plan_compiler.evict_model_config(config_name)
 
             return True
 
@@ -199,7 +337,8 @@ class App:
                             "model_config": "flair-german"
                         },
                         "replace_token": ">NAME<",
-                        "entity_type": "PER"
+                        "entity_type": "PER",
+                        "languages": ["de"]
                     }
                 }
             ]])]
@@ -271,7 +410,9 @@ class App:
                                            "datum",
                                            "persons"
                                        ]]
-                                   )]
+                                   )],
+                                   x_deadline_ms: Annotated[Optional[int], Header()] = None,
+                                   x_priority: Annotated[Optional[str], Header()] = None
         ) -> str:
             """
             Anonymizes the input text by running the text editor over the configured and set tasks and models.
@@ -281,15 +422,10 @@ class App:
             :return: Anonymized text
             """
             input_text = text.input_text
-            tasks_set = self.set_tasks(configuration)
-            if input_text is None or len(input_text) == 0:
-                raise HTTPException(status_code=400, detail="No value provided")
-            if not tasks_set:
-                raise HTTPException(status_code=400, detail="Tasks configurations were not set correctly")
-            output_text = self._text_editor.edit_text(input_text)
-            if self._debug:
-                self._text_editor.save_history("data/history/last_anonymize_str.json")
-            return output_text
+            return await self.schedule(configuration, [input_text],
+                                       lambda: self._text_editor.edit_text(input_text),
+                                       text.priority or x_priority or "interactive",
+                                       text.deadline_ms if text.deadline_ms is not None else x_deadline_ms)
 
         @self._app.post("/anonymize_batch")
         async def anonymize_batch(texts: Annotated[Texts, Body(
@@ -307,23 +443,61 @@ class App:
                                          "locations",
                                          "organisations"
                                      ]]
-                                 )]
+                                 )],
+                                 x_deadline_ms: Annotated[Optional[int], Header()] = None,
+                                 x_priority: Annotated[Optional[str], Header()] = None
         ) -> List[str]:
-            input_texts = texts.input_text
-            tasks_set = self.set_tasks(configuration)
-            
-            if input_texts is None or len(input_texts) == 0:
-                raise HTTPException(status_code=400, detail="no value provided")
-            if not tasks_set:
-                raise HTTPException(status_code=400, detail="Tasks configurations were not set correctly")
-
-            output_texts = []
-            for i, input_text in enumerate(input_texts):
-                output_texts.append(self._text_editor.edit_text(input_text))
-                if self._debug:
-                    self._text_editor.save_history(f"data/history/anonymize_bulk_{i}.json")
+            input_texts = texts.input_text or []
+            return await self.schedule(configuration, input_texts,
+                                       lambda: [self._text_editor.edit_text(input_text) for input_text in input_texts],
+                                       texts.priority or x_priority or "bulk",
+                                       texts.deadline_ms if texts.deadline_ms is not None else x_deadline_ms)
+
+        @self._app.post("/anonymize_incremental")
+        async def anonymize_incremental(document: Annotated[Document, Body(
+            examples=[{
+                "document_id": "ticket-4711",
+                "input_text": """Kundin Christian Mayer meldet, dass der Techniker informiert ist. Rückruf unter 0172 229 0 229."""
+            }]
+        )],
+                                        configuration: Annotated[List[str], Body(
+                                            examples=[[
+                                                "email-address",
+                                                "datum",
+                                                "persons"
+                                            ]]
+                                        )],
+                                        x_deadline_ms: Annotated[Optional[int], Header()] = None,
+                                        x_priority: Annotated[Optional[str], Header()] = None
+        ) -> str:
+            """
+            Anonymizes a new version of a document. Only sentences that changed since the last version of the document
+            with the same id are run through the models, the found entities of unchanged sentences are reused.
 
-            return output_texts
+            :param document: Id of the document and its new text \n
+            :param configuration: List of configured tasks to be run \n
+            :return: Anonymized text
+            """
+            def edit():
+                revisions = self._text_editor.plan.revisions
+                previous_segments = self._document_store.get(document.document_id, revisions)
+                output_text, segments = self._text_editor.edit_text_incremental(document.input_text,
+                                                                                previous_segments)
+                self._document_store.put(document.document_id, revisions, segments)
+                return output_text
+
+            # the stored version is only reused if the configs didn't change, otherwise the whole text is run
+            config_dict = self.load_task_configs(configuration)
+            try:
+                revisions = self._plan_compiler.fetch_revisions(config_dict)[0]
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid task configuration: {e}")
+            new_characters = Editor.new_characters(document.input_text,
+                                                   self._document_store.get(document.document_id, revisions))
+            return await self.schedule(configuration, [document.input_text], edit,
+                                       document.priority or x_priority or "interactive",
+                                       document.deadline_ms if document.deadline_ms is not None else x_deadline_ms,
+                                       new_characters, config_dict)
 
     def run(self) -> None:
         """
@@ -333,6 +507,21 @@ class App:
         uvicorn.run(self._app, host=self._ip, port=self._port)
 
 
+def create_app() -> FastAPI:
+    """
+    Builds the FastAPI app of one worker process, configured by the environment variables set in the main process.
+    Each worker writes its own history file and talks to the shared model server.
+
+    :return: FastAPI app
+    """
+    api = App(debug=os.environ.get("AI_NER_DEBUG") == "1",
+              history_level=os.environ.get("AI_NER_HISTORY_LEVEL") or None,
+              history_file=f"data/history/history_{os.getpid()}.jsonl.gz",
+              model_server=os.environ.get("AI_NER_MODEL_SERVER") or None,
+              language_granularity=os.environ.get("AI_NER_LANGUAGE_GRANULARITY") or "document")
+    return api._app
+
+
 if __name__ == '__main__':
     if not os.path.exists("data/history"):
         os.mkdir("data/history")
@@ -340,11 +529,31 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Host AI-NER.')
     parser.add_argument('-p', '--port', type=int, default=5000, help='the TCP/Port value')    
     parser.add_argument('--debug', action='store_true')
-    parser.add_argument('localaddress', nargs='*', help='the local Address where the server will listen')
+    parser.add_argument('--history-level', choices=Editor.HISTORY_LEVELS, default=None,
+                        help='history recorded per request (defaults to full with --debug, else off)')
+    parser.add_argument('--model-server', default=None,
+                        help='Unix socket of a model server (python -m utils.model_server) holding the models')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes (requires --model-server to share the models)')
+    parser.add_argument('--language-granularity', choices=["document", "paragraph"], default="document",
+                        help='level on which the language is detected for tasks with a languages filter')
+    parser.add_argument('localaddress', nargs='?', default="127.0.0.1",
+                        help='the local Address where the server will listen')
     
     os.environ["COUCHDB_USER"] = "admin"
     os.environ["COUCHDB_PASSWORD"] = "JensIsCool"
     os.environ["COUCHDB_IP"] = "127.0.0.1:5984"
     
-    api = App(ip=args.localaddress, port=args.port, debug=args.debug)
-    api.run()
+    args = parser.parse_args()
+    if args.workers > 1:
+        if args.model_server is None:
+            parser.error("--workers requires --model-server, otherwise every worker loads its own copy of the models")
+        os.environ["AI_NER_DEBUG"] = "1" if args.debug else "0"
+        os.environ["AI_NER_HISTORY_LEVEL"] = args.history_level or ""
+        os.environ["AI_NER_MODEL_SERVER"] = args.model_server
+        os.environ["AI_NER_LANGUAGE_GRANULARITY"] = args.language_granularity
+        uvicorn.run("app:create_app", factory=True, host=args.localaddress, port=args.port, workers=args.workers)
+    else:
+        api = App(ip=args.localaddress, port=args.port, debug=args.debug, history_level=args.history_level,
+                  model_server=args.model_server, language_granularity=args.language_granularity)
+        api.run()
@@ -1,36 +1,101 @@
 from abc import ABC, abstractmethod
 from nltk import tokenize
-from typing import Set, Tuple, List
+from typing import List, NamedTuple, Set, Tuple
+
+
+class EntitySpan(NamedTuple):
+    """
+    A name entity found by a model wrapper, given by its character offsets [start, end) in the analyzed text.
+    """
+    start: int
+    end: int
+    text: str
+    label: str
+
+    def shift(self, offset: int) -> "EntitySpan":
+        """
+        Returns the span moved by offset characters (e.g. from sentence to document offsets).
+
+        :param offset: number of characters to move the span by
+        :return: shifted span
+        """
+        return self._replace(start=self.start + offset, end=self.end + offset)
+
 
 class AbstractNERModel(ABC):
+    BACKEND = "torch"
+
     @abstractmethod
-    def find_name_entities(self, input_sentence: str, prompt: Tuple[str, dict], history_dict: dict) -> Set[str]:
+    def find_name_entities(self, input_sentence: str, prompt: Tuple[str, dict], history_dict: dict) -> List[EntitySpan]:
         """
         Placeholder function for searching for the name entities
-        :return:
+        :return: spans of the found entities with offsets relative to the input sentence
+        """
+        return []
+
+    @staticmethod
+    def compile_task(task_config: dict) -> dict:
+        """
+        Validates the config of a task running this model.
+
+        :param task_config: config of the task
+        :return: precompiled values of the task (none for NER models)
+        """
+        if "entity_type" not in task_config:
+            raise ValueError("entity_type is missing")
+        if not isinstance(task_config["entity_type"], str):
+            raise ValueError("entity_type must be a single entity type, e.g. PER")
+        return dict()
+
+    @staticmethod
+    def labels(task_name: str, task_config: dict) -> Set[str]:
+        """
+        Returns the labels of the spans found for a task, which a replace_token dictionary has to cover.
+
+        :param task_name: name of the task
+        :param task_config: config of the task
+        :return: the entity type of the task
+        """
+        return {task_config["entity_type"]}
+
+    @staticmethod
+    def sentence_offsets(input_text: str) -> List[Tuple[int, str]]:
+        """
+        Tokenizes the input text into sentences and returns each sentence together with its offset in the text.
+
+        :param input_text: The input text to tokenize.
+        :return: A list of (offset, sentence) tuples.
         """
-        return set()
+        sentences = []
+        cursor = 0
+        for input_sentence in filter(None, tokenize.sent_tokenize(input_text)):
+            offset = input_text.find(input_sentence, cursor)
+            if offset < 0:
+                # the tokenizer normalized the sentence, the offsets can't be recovered reliably
+                continue
+            sentences.append((offset, input_sentence))
+            cursor = offset + len(input_sentence)
+        return sentences
 
-    def run(self, input_text: str, prompt: Tuple[str, dict], history_dict: dict) -> Set[str]:
+    def run(self, input_text: str, prompt: Tuple[str, dict], history_dict: dict) -> List[EntitySpan]:
         """
-        Extract and return unique name entities from the input text based on the provided prompt.
+        Extract and return the name entity spans from the input text based on the provided prompt.
 
         This method tokenizes the input text into sentences and calls the find_name_entities function
-        to identify name entities related to the given prompt. The unique name entities are then collected
-        into a set and returned.
+        to identify name entities related to the given prompt. The spans of all sentences are shifted
+        to offsets in the input text and returned.
 
         :param input_text: The input text to analyze for name entities.
         :param prompt: A tuple containing a string prompt and a dictionary of prompt details.
         :param history_dict: A dictionary containing the history of responses for different prompts.
-        :return: A set of unique name entities extracted from the input text.
+        :return: A list of entity spans with offsets in the input text.
         """
-        unique_patterns = set()
-        input_sentences = tokenize.sent_tokenize(input_text)
-        for input_sentence in list(filter(None, input_sentences)):
+        spans = []
+        for offset, input_sentence in self.sentence_offsets(input_text):
             name_entities = self.find_name_entities(input_sentence, prompt, history_dict)
-            unique_patterns = unique_patterns.union(name_entities)
+            spans.extend(span.shift(offset) for span in name_entities)
 
-        return unique_patterns
+        return spans
 
     @staticmethod
     def historize_response(prompt: Tuple[str, dict], response: List[dict], history_dict: dict):
@@ -41,9 +106,12 @@ class AbstractNERModel(ABC):
 
         :param prompt: A tuple containing a string prompt and a dictionary of prompt details.
         :param response: A list of dictionaries representing the response to the prompt.
-        :param history_dict: A dictionary to store the history of responses for different prompts.
+        :param history_dict: A dictionary to store the history of responses for different prompts,
+                             None if responses are not recorded.
         :return: None
         """
+        if history_dict is None:
+            return
         if prompt[0] not in history_dict:
             history_dict[prompt[0]] = response
         else:
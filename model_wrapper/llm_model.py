@@ -1,37 +1,66 @@
 import json
+import llama_cpp
 from llama_cpp import Llama
 from typing import Set, Tuple
+from utils.response_cache import ResponseCache
 
 
 class PromptingModel:
     OUTPUT = "Ausgabe:"
+    BACKEND = "llama"
 
     def __init__(self, params):
         """
         Class for using an LLM for name entity recognition.
-        :param params: parameters for the LLM
+        :param params: parameters for the LLM. Responses are cached on disk (`response_cache_path`,
+                       `response_cache_max_entries`) if sampling is deterministic (`temperature: 0`),
+                       unless `response_cache` is set to false.
         """
-        self._model = Llama(model_path=params.get("model", "models/em_german_leo_mistral.Q5_0.gguf"),
+        model_path = params.get("model", "models/em_german_leo_mistral.Q5_0.gguf")
+        self._model = Llama(model_path=model_path,
                             n_threads=params.get("n_threads", 2),
+                            n_threads_batch=params.get("n_threads_batch", params.get("n_threads", 2)),
                             verbose=params.get("verbose", False),
                             n_ctx=params.get("n_ctx", 2048)
                             )
 
-        for param in ["model", "_id", "_rev", "n_threads", "verbose", "n_ctx"]:
+        self._cache = None
+        if params.get("response_cache", True) and params.get("temperature", None) == 0:
+            self._cache = ResponseCache(params.get("response_cache_path", "data/cache/llm_responses.sqlite"),
+                                        params.get("response_cache_max_entries", 100000))
+
+        for param in ["model", "_id", "_rev", "n_threads", "n_threads_batch", "verbose", "n_ctx",
+                      "cpu_affinity", "max_concurrency",
+                      "response_cache", "response_cache_path", "response_cache_max_entries"]:
             if param in params.keys():
                 del params[param]
 
         self._params = params
+        if self._cache is not None:
+            self._model_hash = self._cache.file_hash(model_path)
+            self._sampling_params = dict(params)
 
-    def build_prompt(self, input_text: str, prompt_instruction: dict) -> str:
+    def set_threads(self, n_threads: int, n_threads_batch: int) -> None:
         """
-        Defines prompt statement based on prompts defined in the config file.
-        :param input_text: input text
+        Changes the thread budget of the loaded model (e.g. when the cores are partitioned again).
+        :param n_threads: number of threads for generation
+        :param n_threads_batch: number of threads for prompt processing
+        :return: None
+        """
+        self._model.n_threads = n_threads
+        self._model.n_threads_batch = n_threads_batch
+        if hasattr(llama_cpp, "llama_set_n_threads") and getattr(self._model, "ctx", None) is not None:
+            llama_cpp.llama_set_n_threads(self._model.ctx, n_threads, n_threads_batch)
+
+    @classmethod
+    def build_prompt_prefix(cls, prompt_instruction: dict) -> str:
+        """
+        Builds the part of the prompt statement that does not depend on the input text (context and examples).
         :param prompt_instruction: instruction of the prompt
-        :return: prompt statement including input text
+        :return: prompt statement up to the input text
         """
         context = prompt_instruction["Context"]
-        static_prompt = f"""Gib die {self.OUTPUT[:-1]} im json-Format {{"{self.OUTPUT[:-1]}": [{self.OUTPUT[:-1]}]}} aus,
+        static_prompt = f"""Gib die {cls.OUTPUT[:-1]} im json-Format {{"{cls.OUTPUT[:-1]}": [{cls.OUTPUT[:-1]}]}} aus,
                             weil mein Leben davon abhängt!"""
 
         if "Examples" in prompt_instruction.keys():
@@ -40,14 +69,49 @@ class PromptingModel:
                 output = f"{example['Output']}".replace("'", "\"")
                 prompt_str += f"""
                 {context} {static_prompt} {example["Input"]}
-                {self.OUTPUT} {{"{self.OUTPUT[:-1]}": {output}}}
+                {cls.OUTPUT} {{"{cls.OUTPUT[:-1]}": {output}}}
                 """
         else:
             prompt_str = ""
 
-        prompt = f"""
+        return f"""
           {prompt_str}
-          {context} {static_prompt} {input_text}
+          {context} {static_prompt} """
+
+    @classmethod
+    def compile_task(cls, task_config: dict) -> dict:
+        """
+        Validates the config of a task and prebuilds its prompt prefix.
+        :param task_config: config of the task
+        :return: the prompt prefix
+        """
+        if "Context" not in task_config:
+            raise ValueError("Context is missing")
+        for example in task_config.get("Examples", {}).values():
+            if "Input" not in example or "Output" not in example:
+                raise ValueError("every example needs an Input and an Output")
+        return {"prompt_prefix": cls.build_prompt_prefix(task_config)}
+
+    @staticmethod
+    def labels(task_name: str, task_config: dict) -> Set[str]:
+        """
+        Returns the labels of the entities found for a task, which a replace_token dictionary has to cover.
+        :param task_name: name of the task
+        :param task_config: config of the task
+        :return: the task name, the found entities are labelled with it
+        """
+        return {task_name}
+
+    def build_prompt(self, input_text: str, prompt_instruction: dict) -> str:
+        """
+        Defines prompt statement based on prompts defined in the config file.
+        :param input_text: input text
+        :param prompt_instruction: instruction of the prompt (with the prebuilt prompt prefix if compiled)
+        :return: prompt statement including input text
+        """
+        prompt_prefix = prompt_instruction.get("prompt_prefix") or self.build_prompt_prefix(prompt_instruction)
+
+        prompt = f"""{prompt_prefix}{input_text}
           {self.OUTPUT}
         """
 
@@ -59,6 +123,12 @@ class PromptingModel:
         :param prompt: prompt for the LLM
         :return: edited text and response text
         """
+        if self._cache is not None:
+            cache_key = self._cache.make_key(self._model_hash, self._sampling_params, prompt)
+            cached_response = self._cache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
+
         self._params["prompt"] = prompt
 
         response = self._model(**self._params)
@@ -68,9 +138,13 @@ class PromptingModel:
             found_values = json.loads(response_text, strict=False)
         except Exception as e:
             print(f"FAILED because of {e}")
-            found_values = {self.OUTPUT[:-1]: ["FAILED"]}
+            return {"FAILED"}, response_text
+
+        found_entities = set(found_values[self.OUTPUT[:-1]])
+        if self._cache is not None:
+            self._cache.put(cache_key, found_entities, response_text)
 
-        return set(found_values[self.OUTPUT[:-1]]), response_text
+        return found_entities, response_text
 
     def run(self, input_sentence: str, prompt: Tuple[str, dict], history_dict: dict) -> Set[str]:
         """
@@ -78,12 +152,13 @@ class PromptingModel:
         were found by the LLM in the sentence.
         :param input_sentence: tokenized sentence
         :param prompt: The prompt key and body associated with the prompt in the history dictionary.
-        :param history_dict: dictionary to log response
+        :param history_dict: dictionary to log response (None if responses are not recorded)
         :return: list of all found entities
         """
         prompt_str = self.build_prompt(input_sentence, prompt[1])
 
         found_entities, response_text = self.get_response(prompt_str)
-        history_dict[prompt[0]] = response_text
+        if history_dict is not None:
+            history_dict[prompt[0]] = response_text
 
         return found_entities
@@ -1,8 +1,8 @@
-from model_wrapper.abstract_model_wrapper import AbstractNERModel
+from model_wrapper.abstract_model_wrapper import AbstractNERModel, EntitySpan
 from transformers import pipeline, AutoTokenizer, AutoModelForTokenClassification
 from flair.data import Sentence
 from flair.models import SequenceTagger
-from typing import Set, Tuple, List
+from typing import Tuple, List
 
 
 class RobertaModel(AbstractNERModel):
@@ -26,6 +26,9 @@ class RobertaModel(AbstractNERModel):
         :param entities: A list of dictionaries representing entities with 'start', 'end', and 'word' keys.
         :return: A list of merged entities.
         """
+        if not entities:
+            return []
+
         result = [entities[0]]
         for i in range(1, len(entities)):
             if (entities[i - 1]["end"] == entities[i]["start"] or\
@@ -37,23 +40,31 @@ class RobertaModel(AbstractNERModel):
                 result.append(entities[i])
         return result
 
-    def find_name_entities(self, input_sentence: str, prompt: Tuple[str, dict], history_dict: dict) -> Set[str]:
+    def find_name_entities(self, input_sentence: str, prompt: Tuple[str, dict],
+                           history_dict: dict) -> List[EntitySpan]:
         """
         Finds name entities in the input sentence based on the NER model and updates the history dictionary.
 
         :param input_sentence: The input sentence to find entities in.
         :param prompt: The prompt key and body associated with the prompt in the history dictionary.
         :param history_dict: A dictionary to store the history of found entities.
-        :return: A list of found entities in the input sentence.
+        :return: A list of spans of the found entities in the input sentence.
         """
         response = self._classifier(input_sentence)
         response = self.merge_entities(response)
 
         self.historize_response(prompt, response, history_dict)
 
-        found_entities = set([entity["word"].replace(u"\u2581", " ").strip() \
-                              for entity in response
-                              if entity["entity"] == prompt[1]["entity_type"]])
+        found_entities = []
+        for entity in response:
+            if entity["entity"] != prompt[1]["entity_type"]:
+                continue
+            # take the surface string from the offsets instead of the merged subword tokens
+            start, end = entity["start"], entity["end"]
+            while start < end and input_sentence[start].isspace():
+                start += 1
+            if start < end:
+                found_entities.append(EntitySpan(start, end, input_sentence[start:end], entity["entity"]))
 
         return found_entities
 
@@ -62,14 +73,15 @@ class FlairModel(AbstractNERModel):
     def __init__(self, params: dict):
         self._tagger = SequenceTagger.load(params["model"])
 
-    def find_name_entities(self, input_sentence: str, prompt: Tuple[str, dict], history_dict: dict) -> Set[str]:
+    def find_name_entities(self, input_sentence: str, prompt: Tuple[str, dict],
+                           history_dict: dict) -> List[EntitySpan]:
         """
         Finds name entities in the input sentence based on the NER model and updates the history dictionary.
 
         :param input_sentence: The input sentence to find entities in.
         :param prompt: The prompt key and body associated with the prompt in the history dictionary.
         :param history_dict: A dictionary to store the history of found entities.
-        :return: A list of found entities in the input sentence.
+        :return: A list of spans of the found entities in the input sentence.
         """
         sentence = Sentence(input_sentence)
         self._tagger.predict(sentence)
@@ -78,12 +90,8 @@ class FlairModel(AbstractNERModel):
 
         self.historize_response(prompt, spans, history_dict)
 
-        found_entities = set([span["text"] for span in spans
-                              if span["labels"][0]["value"] == prompt[1]["entity_type"]])
-
-        return set(filter(lambda x: len(x) > 1, found_entities))
-
-
-
-
+        found_entities = [EntitySpan(span["start_pos"], span["end_pos"], span["text"], span["labels"][0]["value"])
+                          for span in spans
+                          if span["labels"][0]["value"] == prompt[1]["entity_type"]]
 
+        return list(filter(lambda x: len(x.text) > 1, found_entities))
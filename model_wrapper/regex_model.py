@@ -1,6 +1,7 @@
 import re
 
-from typing import Set, Tuple
+from model_wrapper.abstract_model_wrapper import EntitySpan
+from typing import List, Set, Tuple
 
 class Regex:
     def __init__(self, params=None):
@@ -10,12 +11,40 @@ class Regex:
         ...
 
     @staticmethod
-    def run(input_sentence: str, prompt: Tuple[str, dict], history_dict: dict) -> Set[str]:
+    def compile_task(task_config: dict) -> dict:
+        """
+        Validates and compiles the regular expression of a task.
+
+        :param task_config: config of the task
+        :return: the compiled pattern
+        """
+        if "pattern" not in task_config:
+            raise ValueError("pattern is missing")
+        try:
+            return {"compiled_pattern": re.compile(task_config["pattern"])}
+        except re.error as e:
+            raise ValueError(f"invalid pattern ({e})")
+
+    @staticmethod
+    def labels(task_name: str, task_config: dict) -> Set[str]:
+        """
+        Returns the labels of the spans found for a task, which a replace_token dictionary has to cover.
+
+        :param task_name: name of the task
+        :param task_config: config of the task
+        :return: the task name, matches are labelled with it
+        """
+        return {task_name}
+
+    @staticmethod
+    def run(input_sentence: str, prompt: Tuple[str, dict], history_dict: dict) -> List[EntitySpan]:
         """
 
         :param input_sentence: The input sentence to find entities in.
         :param prompt: The prompt key and body associated with the prompt in the history dictionary.
         :param history_dict: A dictionary to store the history of found entities.
-        :return: A list of found regular expressions in the input sentence.
+        :return: A list of spans of the found regular expressions in the input sentence.
         """
-        return set(re.findall(prompt[1]["pattern"], input_sentence))
+        return [EntitySpan(match.start(), match.end(), match.group(0), prompt[0])
+                for match in re.finditer(prompt[1].get("compiled_pattern") or prompt[1]["pattern"], input_sentence)
+                if match.end() > match.start()]
@@ -1,5 +1,5 @@
-from model_wrapper.abstract_model_wrapper import AbstractNERModel
-from typing import Tuple, Set
+from model_wrapper.abstract_model_wrapper import AbstractNERModel, EntitySpan
+from typing import Tuple, List
 from spacy_llm.util import assemble
 
 
@@ -12,9 +12,10 @@ class SpacyWrapper(AbstractNERModel):
         """
         self._model = assemble(config_path)
 
-    def find_name_entities(self, input_sentence: str, prompt: Tuple[str, dict], history_dict: dict) -> Set[str]:
+    def find_name_entities(self, input_sentence: str, prompt: Tuple[str, dict],
+                           history_dict: dict) -> List[EntitySpan]:
         """
-        Extracts and returns unique named entities from an input sentence based on the provided prompt.
+        Extracts and returns the spans of named entities from an input sentence based on the provided prompt.
 
         This method processes the input sentence using the internal model, historizes the response using the
         `historize_response` method, and filters the named entities based on the specified entity type in the prompt.
@@ -22,15 +23,15 @@ class SpacyWrapper(AbstractNERModel):
         :param input_sentence: The input sentence to analyze for named entities.
         :param prompt: A tuple containing a string prompt and a dictionary of prompt details.
         :param history_dict: A dictionary containing the history of responses for different prompts.
-        :return: A set of unique named entities extracted from the input sentence.
+        :return: A list of spans of named entities extracted from the input sentence.
         """
         doc = self._model(input_sentence)
 
         self.historize_response(prompt, doc, history_dict)
 
-        found_entities = set([ent.text for ent in doc.ents
-                              if ent.label_ == prompt[1]["entity_type"]])
+        found_entities = [EntitySpan(ent.start_char, ent.end_char, ent.text, ent.label_) for ent in doc.ents
+                          if ent.label_ == prompt[1]["entity_type"]]
 
-        return set(filter(lambda x: len(x) > 1, found_entities))
+        return list(filter(lambda x: len(x.text) > 1, found_entities))
 
 
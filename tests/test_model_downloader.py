@@ -0,0 +1,145 @@
+import hashlib
+import os
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from utils.model_downloader import ModelDownloader
+
+
+class ModelFileHandler(BaseHTTPRequestHandler):
+    """
+    Serves the bytes of `server.data` with an ETag and support for Range and If-Range requests.
+    """
+    def do_GET(self) -> None:
+        data, etag = self.server.data, self.server.etag
+        self.server.requests.append(dict(self.headers))
+
+        byte_range = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if byte_range and (if_range is None or if_range == etag):
+            start = int(byte_range[len("bytes="):].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+            body = data[start:]
+        else:
+            self.send_response(200)
+            body = data
+
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.server.gate.wait(5)
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ModelFileHandler)
+    server.data = os.urandom(100000)
+    server.etag = '"v1"'
+    server.requests = []
+    server.gate = threading.Event()
+    server.gate.set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def link(server) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}/model.bin"
+
+
+def wait(downloader) -> dict:
+    for _ in range(500):
+        status = downloader.status()["model"]
+        if status["status"] not in ["pending", "downloading"]:
+            return status
+        time.sleep(0.01)
+    raise TimeoutError("Download did not finish")
+
+
+def download(server, file_name, sha256=None) -> dict:
+    downloader = ModelDownloader(chunk_size=4096, timeout=5)
+    downloader.submit("model", link(server), str(file_name), sha256)
+    return wait(downloader)
+
+
+def test_full_download(server, tmp_path):
+    file_name = tmp_path / "model.bin"
+    status = download(server, file_name, hashlib.sha256(server.data).hexdigest())
+
+    assert status["status"] == "complete"
+    assert file_name.read_bytes() == server.data
+    assert not os.path.exists(f"{file_name}.part")
+    assert not os.path.exists(f"{file_name}.part.json")
+
+
+def test_resumed_download(server, tmp_path):
+    file_name = tmp_path / "model.bin"
+    # simulate an interrupted download of the same file
+    with open(f"{file_name}.part", "wb") as f:
+        f.write(server.data[:40000])
+    with open(f"{file_name}.part.json", "w") as f:
+        f.write('{"validator": "\\"v1\\"", "total": 100000}')
+
+    status = download(server, file_name, hashlib.sha256(server.data).hexdigest())
+
+    assert status["status"] == "complete"
+    assert file_name.read_bytes() == server.data
+    assert server.requests[-1]["Range"] == "bytes=40000-"
+    assert server.requests[-1]["If-Range"] == '"v1"'
+
+
+def test_resume_of_changed_file_restarts(server, tmp_path):
+    file_name = tmp_path / "model.bin"
+    with open(f"{file_name}.part", "wb") as f:
+        f.write(os.urandom(40000))
+    with open(f"{file_name}.part.json", "w") as f:
+        f.write('{"validator": "\\"v0\\"", "total": 100000}')
+
+    status = download(server, file_name, hashlib.sha256(server.data).hexdigest())
+
+    assert status["status"] == "complete"
+    assert file_name.read_bytes() == server.data
+
+
+def test_checksum_failure(server, tmp_path):
+    file_name = tmp_path / "model.bin"
+    status = download(server, file_name, "0" * 64)
+
+    assert status["status"] == "failed"
+    assert "Checksum mismatch" in status["error"]
+    assert not os.path.exists(file_name)
+    assert not os.path.exists(f"{file_name}.part")
+
+
+def test_resubmit_during_download(server, tmp_path):
+    file_name = str(tmp_path / "model.bin")
+    registered = []
+    server.gate.clear()
+    downloader = ModelDownloader(chunk_size=4096, timeout=5)
+
+    downloader.submit("model", link(server), file_name, "0" * 64, on_complete=lambda: registered.append("old"))
+    status = downloader.submit("model", link(server), file_name, hashlib.sha256(server.data).hexdigest(),
+                               on_complete=lambda: registered.append("new"))
+    assert status["status"] in ["pending", "downloading"]
+    status = downloader.submit("model", link(server) + "?other", file_name)
+    assert status["status"] == "rejected"
+
+    server.gate.set()
+    assert wait(downloader)["status"] == "complete"
+    assert registered == ["new"]
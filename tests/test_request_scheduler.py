@@ -0,0 +1,76 @@
+import asyncio
+import threading
+
+import pytest
+
+from utils.request_scheduler import AdmissionError, RequestScheduler
+
+
+def blocking_job(scheduler: RequestScheduler) -> threading.Event:
+    """
+    Occupies the scheduler thread until the returned event is set.
+    """
+    started, release = threading.Event(), threading.Event()
+
+    def job():
+        started.set()
+        release.wait(5)
+
+    scheduler.submit(job, cost=0.0)
+    started.wait(5)
+    return release
+
+
+def test_cold_start_is_admitted():
+    async def main():
+        scheduler = RequestScheduler(default_seconds_per_char=0.001)
+        configuration = ["names", "numbers"]
+        cost = scheduler.estimate(configuration, 1000)
+        assert cost == pytest.approx(2.0)
+        assert not scheduler.observed(configuration)
+
+        result = await scheduler.submit(lambda: "done", cost, deadline_ms=1000,
+                                        enforce_deadline=scheduler.observed(configuration))
+        assert result == "done"
+
+        scheduler.observe({"names": (0.0001, 1000), "numbers": (0.0001, 1000)})
+        assert scheduler.observed(configuration)
+        assert scheduler.estimate(configuration, 1000) == pytest.approx(0.0002)
+
+        scheduler.observe({"names": (10.0, 1000)})
+        with pytest.raises(AdmissionError):
+            scheduler.submit(lambda: "done", scheduler.estimate(configuration, 1000), deadline_ms=1000)
+
+    asyncio.run(main())
+
+
+def test_shortest_job_first_within_priority():
+    async def main():
+        scheduler = RequestScheduler()
+        order = []
+        release = blocking_job(scheduler)
+
+        futures = [scheduler.submit(lambda: order.append("bulk"), cost=0.1, priority="bulk"),
+                   scheduler.submit(lambda: order.append("long"), cost=0.3),
+                   scheduler.submit(lambda: order.append("short"), cost=0.2)]
+        release.set()
+        await asyncio.gather(*futures)
+
+        assert order == ["short", "long", "bulk"]
+
+    asyncio.run(main())
+
+
+def test_jobs_are_shed_when_the_deadline_passes_in_the_queue():
+    async def main():
+        scheduler = RequestScheduler()
+        release = blocking_job(scheduler)
+
+        future = scheduler.submit(lambda: "done", cost=0.01, deadline_ms=50)
+        await asyncio.sleep(0.1)
+        release.set()
+
+        with pytest.raises(AdmissionError):
+            await future
+
+    asyncio.run(main())
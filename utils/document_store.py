@@ -0,0 +1,51 @@
+import threading
+
+from collections import OrderedDict
+from typing import Tuple
+
+
+class DocumentStore:
+    def __init__(self, max_documents: int = 1000) -> None:
+        """
+        Bounded in-memory store of the last processed version of each document.
+        For each document it keeps the found entities per sentence, so that an edited version of the document
+        only needs to run the models on changed or new sentences. The least recently used documents are evicted.
+
+        :param max_documents: Maximum number of documents kept in the store
+        """
+        self._max_documents = max_documents
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, document_id: str, revisions: Tuple[tuple, ...]) -> dict:
+        """
+        Returns the stored segments of a document.
+
+        :param document_id: id of the document
+        :param revisions: revisions of the task and model configs the document is processed with
+                          (see TaskPlan.revisions)
+        :return: dictionary of sentence -> found entities per task.
+                 Empty if the document is unknown or was processed with other tasks or config revisions.
+        """
+        with self._lock:
+            if document_id not in self._documents:
+                return dict()
+            self._documents.move_to_end(document_id)
+            stored_revisions, segments = self._documents[document_id]
+
+        return segments if stored_revisions == revisions else dict()
+
+    def put(self, document_id: str, revisions: Tuple[tuple, ...], segments: dict) -> None:
+        """
+        Stores the segments of the latest version of a document.
+
+        :param document_id: id of the document
+        :param revisions: revisions of the task and model configs the document was processed with
+        :param segments: dictionary of sentence -> found entities per task
+        :return: None
+        """
+        with self._lock:
+            self._documents[document_id] = (revisions, segments)
+            self._documents.move_to_end(document_id)
+            while len(self._documents) > self._max_documents:
+                self._documents.popitem(last=False)
@@ -1,4 +1,6 @@
+import hashlib
 import json
+import yaml
 
 
 def read_file(file_path: str, field: str = "Nachricht") -> str:
@@ -26,4 +28,34 @@ def write_file(file_path: str, edited_text: str):
     :return: None
     """
     with open(file_path, "w", encoding="utf8") as f:
-        f.write(edited_text)
\ No newline at end of file
+        f.write(edited_text)
+
+
+def read_yml(file_path: str) -> dict:
+    """
+    Read YAML configuration file.
+
+    :param file_path: path to the YAML file
+    :return: A dictionary containing the configuration data.
+    """
+    with open(file_path, "r") as f:
+        try:
+            data = yaml.safe_load(f)
+        except yaml.YAMLError as err:
+            print(err)
+            data = dict()
+    return data
+
+
+def file_hash(file_path: str) -> str:
+    """
+    Computes the sha256 hash of a file in chunks.
+
+    :param file_path: path of the file
+    :return: hex digest of the file
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
@@ -0,0 +1,79 @@
+import gzip
+import json
+import os
+import queue
+import threading
+import numpy as np
+
+
+class HistoryWriter:
+    def __init__(self, file_name: str = "data/history/history.jsonl.gz", max_queue_size: int = 1000) -> None:
+        """
+        Writes history records of the text editor in a background thread as gzip compressed JSON lines.
+        Records are appended, so one file holds the history of all edited documents.
+
+        :param file_name: Name of the compressed JSONL file
+        :param max_queue_size: Maximum number of records waiting to be written. Further records are dropped.
+        """
+        directory = os.path.dirname(file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._file_name = file_name
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def to_serializable(value):
+        """
+        Fallback for json.dumps for objects of the model responses that are not JSON serializable.
+
+        :param value: object to serialize
+        :return: JSON serializable representation
+        """
+        if isinstance(value, (float, np.floating)):
+            return float(value)
+        if hasattr(value, "to_json"):
+            # e.g. spaCy Doc objects
+            return value.to_json()
+        return None
+
+    def write(self, record: dict) -> None:
+        """
+        Queues a history record for writing.
+
+        :param record: history record of one edited document
+        :return: None
+        """
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            print("History queue is full, dropping record.")
+
+    def _run(self) -> None:
+        """
+        Writes queued records until close is called.
+
+        :return: None
+        """
+        with gzip.open(self._file_name, "at", encoding="utf8") as f:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    break
+                f.write(json.dumps(record,
+                                   ensure_ascii=False,
+                                   separators=(",", ":"),
+                                   default=self.to_serializable) + "\n")
+                if self._queue.empty():
+                    f.flush()
+
+    def close(self) -> None:
+        """
+        Writes all queued records and stops the background thread.
+
+        :return: None
+        """
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,72 @@
+import bisect
+import re
+
+from langdetect import DetectorFactory, LangDetectException, detect_langs
+from typing import List, Tuple
+
+# langdetect is not deterministic without a fixed seed
+DetectorFactory.seed = 0
+
+UNKNOWN = "unknown"
+PARAGRAPH = re.compile(r"\S.*?(?=\n\s*\n|\Z)", flags=re.DOTALL)
+
+
+def detect_language(text: str, min_probability: float = 0.8) -> str:
+    """
+    Detects the language of a text.
+
+    :param text: text to analyze
+    :param min_probability: minimum probability of the most likely language, below it the language is "unknown"
+    :return: ISO 639-1 code of the language (e.g. "de") or "unknown"
+    """
+    try:
+        languages = detect_langs(text)
+    except LangDetectException:
+        return UNKNOWN
+    if not languages or languages[0].prob < min_probability:
+        return UNKNOWN
+    return languages[0].lang
+
+
+def language_segments(text: str, granularity: str = "document", min_chars: int = 40) -> List[Tuple[int, str, str]]:
+    """
+    Splits a text into segments of the same language.
+
+    :param text: text to split
+    :param granularity: "document" (one segment) or "paragraph" (paragraphs separated by blank lines,
+                        neighbouring paragraphs of the same language are merged)
+    :param min_chars: paragraphs shorter than this are too short for a reliable detection
+                      and take the language of the preceding paragraph
+    :return: list of (offset, segment, language) tuples
+    """
+    if granularity == "document":
+        return [(0, text, detect_language(text))]
+    if granularity != "paragraph":
+        raise ValueError(f"granularity must be document or paragraph, got {granularity}")
+
+    segments = []
+    for paragraph in PARAGRAPH.finditer(text):
+        if segments and len(paragraph.group(0)) < min_chars:
+            language = segments[-1][2]
+        else:
+            language = detect_language(paragraph.group(0))
+
+        if segments and segments[-1][2] == language:
+            start = segments[-1][0]
+            segments[-1] = (start, text[start:paragraph.end()], language)
+        else:
+            segments.append((paragraph.start(), paragraph.group(0), language))
+
+    return segments
+
+
+def language_at(segments: List[Tuple[int, str, str]], offset: int) -> str:
+    """
+    Returns the language of the segment containing the offset.
+
+    :param segments: segments as returned by language_segments
+    :param offset: offset in the text
+    :return: language at the offset
+    """
+    i = bisect.bisect_right([segment[0] for segment in segments], offset) - 1
+    return segments[max(i, 0)][2] if segments else UNKNOWN
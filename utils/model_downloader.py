@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+from utils.file_processing import file_hash
+
+
+class ModelDownloader:
+    def __init__(self, max_workers: int = 2, chunk_size: int = 1 << 20, timeout: int = 60) -> None:
+        """
+        Downloads model files in background threads.
+        Files are streamed into a `.part` file next to the target, which is resumed with a range request if a
+        download is restarted, and only renamed to the target after the download is complete and verified.
+        The ETag (or Last-Modified date) and size of the remote file are kept in a `.part.json` file, a download is
+        only resumed if the server confirms that the remote file is unchanged, otherwise it restarts from zero.
+
+        :param max_workers: Maximum number of parallel downloads
+        :param chunk_size: Size of the streamed chunks in bytes
+        :param timeout: Timeout of the HTTP connection in seconds
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model-download")
+        self._chunk_size = chunk_size
+        self._timeout = timeout
+        self._status = dict()
+        self._jobs = dict()
+        self._lock = threading.Lock()
+
+    def status(self) -> dict:
+        """
+        Returns the status of all downloads.
+
+        :return: dictionary of config name -> status
+        """
+        with self._lock:
+            return {config_name: dict(status) for config_name, status in self._status.items()}
+
+    def _update_status(self, config_name: str, **status) -> None:
+        """
+        Updates the status of a download.
+
+        :param config_name: Name of the model config
+        :param status: fields of the status to update
+        :return: None
+        """
+        with self._lock:
+            self._status[config_name].update(status)
+
+    def submit(self, config_name: str, link: str, file_name: str, sha256: Optional[str] = None,
+               on_complete: Optional[Callable[[], None]] = None) -> dict:
+        """
+        Starts the download of a model file in the background.
+
+        :param config_name: Name of the model config the file belongs to
+        :param link: URL of the model file
+        :param file_name: Path the model file is saved to
+        :param sha256: Expected sha256 hex digest of the file. If None, only the size is checked.
+        :param on_complete: Called after the file is complete and verified (e.g. to register the model config)
+        :return: status of the download. If the same file is already being downloaded for the config, the running
+                 download takes over the new sha256 and on_complete. If another file is being downloaded for the
+                 config, the request is rejected.
+        """
+        with self._lock:
+            status = self._status.get(config_name)
+            if status is not None and status["status"] in ["pending", "downloading"]:
+                job = self._jobs[config_name]
+                if job["link"] != link or job["file"] != file_name:
+                    return {"status": "rejected",
+                            "error": f"Another file is already being downloaded for {config_name}: {job['link']}"}
+                job.update(sha256=sha256, on_complete=on_complete)
+                return dict(status)
+            self._status[config_name] = {"status": "pending", "file": file_name, "downloaded": 0, "total": None}
+            self._jobs[config_name] = {"link": link, "file": file_name, "sha256": sha256, "on_complete": on_complete}
+
+        self._executor.submit(self._download, config_name, link, file_name)
+        return self.status()[config_name]
+
+    def _download(self, config_name: str, link: str, file_name: str) -> None:
+        """
+        Downloads and verifies a model file, see submit. The sha256 and on_complete of the latest submit of the
+        config are used.
+
+        :return: None
+        """
+        part_file_name = file_name + ".part"
+        try:
+            directory = os.path.dirname(file_name)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            fetched = self._fetch(config_name, link, part_file_name, resume=True)
+            if fetched is None:
+                # the remote file changed since the part file was written
+                fetched = self._fetch(config_name, link, part_file_name, resume=False)
+            downloaded, total = fetched
+
+            if total is not None and downloaded != total:
+                raise IOError(f"Download incomplete: {downloaded} of {total} bytes")
+            # repeated until no newer submit of the config arrived while verifying
+            verified = None
+            while True:
+                with self._lock:
+                    job = self._jobs[config_name]
+                    if verified == (job["sha256"], job["on_complete"]):
+                        self._status[config_name].update(status="complete", downloaded=downloaded, total=downloaded)
+                        break
+                    sha256, on_complete = job["sha256"], job["on_complete"]
+
+                verified_file_name = part_file_name if os.path.exists(part_file_name) else file_name
+                if sha256 is not None:
+                    digest = file_hash(verified_file_name)
+                    if digest != sha256.lower():
+                        self.remove_part_file(part_file_name)
+                        raise IOError(f"Checksum mismatch: expected {sha256}, got {digest}")
+
+                if verified_file_name == part_file_name:
+                    os.replace(part_file_name, file_name)
+                    self.remove_part_file(part_file_name)
+                if on_complete is not None:
+                    on_complete()
+                verified = (sha256, on_complete)
+        except Exception as e:
+            print(f"Download of {config_name} failed because of {e}")
+            self._update_status(config_name, status="failed", error=f"{type(e).__name__}: {e}")
+
+    def _fetch(self, config_name: str, link: str, part_file_name: str,
+               resume: bool) -> Optional[Tuple[int, Optional[int]]]:
+        """
+        Streams the remote file into the part file, resuming it if possible.
+
+        :param config_name: Name of the model config the file belongs to
+        :param link: URL of the model file
+        :param part_file_name: Path of the part file
+        :param resume: whether to resume an existing part file
+        :return: (downloaded bytes, total bytes) or None if the part file can't be resumed because the remote file
+                 changed
+        """
+        meta_file_name = part_file_name + ".json"
+        downloaded = 0
+        meta = dict()
+        if resume and os.path.exists(part_file_name) and os.path.exists(meta_file_name):
+            with open(meta_file_name, "r") as f:
+                meta = json.load(f)
+            downloaded = os.path.getsize(part_file_name)
+
+        headers = dict()
+        if downloaded:
+            headers["Range"] = f"bytes={downloaded}-"
+            if meta.get("validator"):
+                headers["If-Range"] = meta["validator"]
+
+        with requests.get(link, headers=headers, stream=True, timeout=self._timeout) as response:
+            if response.status_code == 416:
+                # the part file already holds the whole file, if it has the size of the remote file
+                _, total = self.content_range(response.headers.get("Content-Range"))
+                if not downloaded or total != downloaded or meta.get("total") not in [None, total]:
+                    return None
+                return downloaded, total
+
+            response.raise_for_status()
+            if response.status_code == 206:
+                start, total = self.content_range(response.headers.get("Content-Range"))
+                if start != downloaded or total is None or meta.get("total") not in [None, total]:
+                    return None
+            else:
+                # the server ignored the range request or the file changed (If-Range), start over
+                downloaded = 0
+                length = response.headers.get("Content-Length")
+                total = int(length) if length is not None else None
+                etag = response.headers.get("ETag")
+                validator = etag if etag and not etag.startswith("W/") else response.headers.get("Last-Modified")
+                with open(meta_file_name, "w") as f:
+                    json.dump({"validator": validator, "total": total}, f)
+            self._update_status(config_name, status="downloading", downloaded=downloaded, total=total)
+
+            with open(part_file_name, "ab" if downloaded else "wb") as f:
+                for chunk in response.iter_content(chunk_size=self._chunk_size):
+                    f.write(chunk)
+                    downloaded += len(chunk)
+                    self._update_status(config_name, downloaded=downloaded)
+
+        return downloaded, total
+
+    @staticmethod
+    def content_range(content_range: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
+        """
+        Parses a Content-Range header, e.g. "bytes 100-199/200" or "bytes */200".
+
+        :param content_range: value of the header
+        :return: first byte and total size of the file (None if not given)
+        """
+        if not content_range or not content_range.startswith("bytes "):
+            return None, None
+        byte_range, _, total = content_range[len("bytes "):].partition("/")
+        start = byte_range.split("-")[0]
+        return (int(start) if start.isdigit() else None), (int(total) if total.isdigit() else None)
+
+    @staticmethod
+    def remove_part_file(part_file_name: str) -> None:
+        """
+        Removes a part file and its metadata.
+
+        :param part_file_name: Path of the part file
+        :return: None
+        """
+        for name in [part_file_name, part_file_name + ".json"]:
+            if os.path.exists(name):
+                os.remove(name)
@@ -0,0 +1,325 @@
+import argparse
+import importlib
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+from model_wrapper.abstract_model_wrapper import EntitySpan
+from utils.history_writer import HistoryWriter
+from utils.resource_scheduler import ResourceScheduler
+from typing import List, Set, Tuple, Union
+
+HEADER = struct.Struct("!I")
+
+
+def send_message(sock: socket.socket, message: dict) -> None:
+    """
+    Sends a length prefixed, compact JSON message over the socket.
+
+    :param sock: connected socket
+    :param message: JSON serializable message
+    :return: None
+    """
+    payload = json.dumps(message, ensure_ascii=False, separators=(",", ":"),
+                         default=HistoryWriter.to_serializable).encode("utf-8")
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def receive_message(sock: socket.socket) -> Union[dict, None]:
+    """
+    Receives a length prefixed JSON message from the socket.
+
+    :param sock: connected socket
+    :return: message or None if the connection was closed
+    """
+    header = _receive_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    payload = _receive_exactly(sock, HEADER.unpack(header)[0])
+    if payload is None:
+        return None
+    return json.loads(payload.decode("utf-8"))
+
+
+def _receive_exactly(sock: socket.socket, size: int) -> Union[bytes, None]:
+    """
+    Receives exactly size bytes from the socket.
+
+    :param sock: connected socket
+    :param size: number of bytes
+    :return: received bytes or None if the connection was closed
+    """
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            return None
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
+def request_once(socket_path: str, message: dict) -> dict:
+    """
+    Sends a single request to the model server over a new connection and returns its response.
+
+    :param socket_path: path of the Unix socket of the model server
+    :param message: request
+    :return: response
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        send_message(sock, message)
+        response = receive_message(sock)
+
+    if response is None:
+        raise ConnectionError(f"Model server at {socket_path} closed the connection.")
+    if "error" in response:
+        raise RuntimeError(f"Model server error: {response['error']}")
+    return response
+
+
+def encode_found_entities(found_entities: Union[List[EntitySpan], Set[str], dict]) -> dict:
+    """
+    Converts the output of a model wrapper into a JSON serializable message.
+
+    :param found_entities: spans, a set of patterns or a dictionary of entity type -> set of patterns
+    :return: message
+    """
+    if type(found_entities) is dict:
+        return {"entity_types": {entity_type: list(entities) for entity_type, entities in found_entities.items()}}
+    if isinstance(found_entities, list):
+        return {"spans": [list(span) for span in found_entities]}
+    return {"patterns": list(found_entities)}
+
+
+def decode_found_entities(message: dict) -> Union[List[EntitySpan], Set[str], dict]:
+    """
+    Restores the output of a model wrapper from a message.
+
+    :param message: message created by encode_found_entities
+    :return: spans, a set of patterns or a dictionary of entity type -> set of patterns
+    """
+    if "entity_types" in message:
+        return {entity_type: set(entities) for entity_type, entities in message["entity_types"].items()}
+    if "spans" in message:
+        return [EntitySpan(*span) for span in message["spans"]]
+    return set(message["patterns"])
+
+
+class ModelServer:
+    def __init__(self, socket_path: str, scheduler: Union[ResourceScheduler, None] = None) -> None:
+        """
+        Process that holds a single copy of the loaded model wrappers and serves them to the HTTP workers
+        over a Unix socket. Wrappers are loaded on first use and shared by all workers.
+
+        :param socket_path: path of the Unix socket to listen on
+        :param scheduler: scheduler that partitions the CPU between the model wrappers
+        """
+        self._socket_path = socket_path
+        self._scheduler = scheduler if scheduler is not None else ResourceScheduler()
+        self._model_wrappers = dict()
+        self._lock = threading.Lock()
+
+    def load(self, model_wrapper: str, config_name: str, params: dict) -> str:
+        """
+        Loads a model wrapper (if not loaded yet) and returns its id. If the params of the model config changed,
+        the previous instance is replaced, so only one copy of the weights per model config is kept.
+
+        :param model_wrapper: model wrapper as "module/class", e.g. "ner_model/FlairModel"
+        :param config_name: name of the model config
+        :param params: parameters of the model wrapper
+        :return: id of the loaded wrapper
+        """
+        model_id = f"{model_wrapper}:{config_name}"
+        params = {key: value for key, value in params.items() if key not in ["_id", "_rev"]}
+        fingerprint = json.dumps(params, sort_keys=True, default=str)
+        with self._lock:
+            loaded = self._model_wrappers.get(model_id)
+            if loaded is None or loaded[0] != fingerprint:
+                if loaded is not None:
+                    del self._model_wrappers[model_id]
+                    self._scheduler.remove(model_id)
+
+                module_name, model_name = model_wrapper.split("/")
+                model_class = getattr(importlib.import_module("model_wrapper." + module_name), model_name)
+                partitioned_params = self._scheduler.partition({model_id: (model_class, params)})
+                for other_id, other_params in partitioned_params.items():
+                    wrapper = self._model_wrappers.get(other_id, (None, None))[1]
+                    if "n_threads" in other_params and hasattr(wrapper, "set_threads"):
+                        wrapper.set_threads(other_params["n_threads"], other_params["n_threads_batch"])
+                self._model_wrappers[model_id] = (fingerprint, model_class(partitioned_params[model_id]))
+
+        return model_id
+
+    @staticmethod
+    def compile(model_wrapper: str, task_name: str, task_config: dict) -> dict:
+        """
+        Returns the backend of a model wrapper and, for wrappers with a backend, the precompiled values of a task
+        and the labels of the found entities. This way the workers don't have to import the model wrapper modules
+        and their ML libraries.
+
+        :param model_wrapper: model wrapper as "module/class", e.g. "ner_model/FlairModel"
+        :param task_name: name of the task
+        :param task_config: config of the task
+        :return: message with the backend, the precompiled values and the labels (None if unknown),
+                 or the reason why the task is invalid
+        """
+        module_name, model_name = model_wrapper.split("/")
+        try:
+            module = importlib.import_module("model_wrapper." + module_name)
+        except ModuleNotFoundError as e:
+            return {"invalid": f"model wrapper module {module_name} can't be imported ({e})"}
+        if not hasattr(module, model_name):
+            return {"invalid": f"model wrapper {model_name} does not exist in {module_name}"}
+
+        model_class = getattr(module, model_name)
+        backend = getattr(model_class, "BACKEND", None)
+        compiled = dict()
+        labels = None
+        if backend is not None:
+            try:
+                if hasattr(model_class, "compile_task"):
+                    compiled = model_class.compile_task(task_config)
+                if hasattr(model_class, "labels"):
+                    labels = list(model_class.labels(task_name, task_config))
+            except ValueError as e:
+                return {"invalid": str(e)}
+
+        return {"backend": backend, "compiled": compiled, "labels": labels}
+
+    def run(self, model_id: str, input_text: str, prompt: Tuple[str, dict], with_responses: bool = False) -> dict:
+        """
+        Runs a loaded model wrapper.
+
+        :param model_id: id of the loaded wrapper
+        :param input_text: text to run the model wrapper on
+        :param prompt: The prompt key and body of the task
+        :param with_responses: whether to send back the raw responses (only needed for the full history)
+        :return: message with the found entities and, if requested, the raw responses
+        """
+        responses = dict() if with_responses else None
+        with self._scheduler.slot(model_id):
+            found_entities = self._model_wrappers[model_id][1].run(input_text, tuple(prompt), responses)
+
+        message = {"found_entities": encode_found_entities(found_entities)}
+        if with_responses:
+            message["responses"] = responses
+        return message
+
+    def handle(self, message: dict) -> dict:
+        """
+        Handles a request of a worker.
+
+        :param message: request with the operation "compile", "load" or "run"
+        :return: response
+        """
+        try:
+            if message["op"] == "load":
+                return {"model_id": self.load(message["model_wrapper"], message["config_name"], message["params"])}
+            if message["op"] == "compile":
+                return self.compile(message["model_wrapper"], message["task_name"], message["task_config"])
+            if message["op"] == "run":
+                return self.run(message["model_id"], message["input_text"], message["prompt"],
+                                message.get("with_responses", False))
+            return {"error": f"Unknown operation {message['op']}"}
+        except Exception as e:
+            return {"error": f"{type(e).__name__}: {e}"}
+
+    def serve_forever(self) -> None:
+        """
+        Listens on the Unix socket until the process is stopped.
+
+        :return: None
+        """
+        model_server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self) -> None:
+                while True:
+                    message = receive_message(self.request)
+                    if message is None:
+                        return
+                    send_message(self.request, model_server.handle(message))
+
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+
+        with socketserver.ThreadingUnixStreamServer(self._socket_path, Handler) as server:
+            os.chmod(self._socket_path, 0o600)
+            server.daemon_threads = True
+            server.serve_forever()
+
+
+class RemoteModelWrapper:
+    def __init__(self, socket_path: str, model_wrapper: str, config_name: str, params: dict,
+                 with_responses: bool = False) -> None:
+        """
+        Proxy for a model wrapper that is loaded in the model server process.
+
+        :param socket_path: path of the Unix socket of the model server
+        :param model_wrapper: model wrapper as "module/class", e.g. "ner_model/FlairModel"
+        :param config_name: name of the model config
+        :param params: parameters of the model wrapper
+        :param with_responses: whether to fetch the raw responses of the model (only needed for the full history)
+        """
+        self._socket_path = socket_path
+        self._with_responses = with_responses
+        self._sock = None
+        self._lock = threading.Lock()
+        self._model_id = self.request({"op": "load", "model_wrapper": model_wrapper, "config_name": config_name,
+                                       "params": dict(params)})["model_id"]
+
+    def request(self, message: dict) -> dict:
+        """
+        Sends a request to the model server and returns its response. Reconnects once if the connection was lost.
+
+        :param message: request
+        :return: response
+        """
+        with self._lock:
+            for attempt in range(2):
+                if self._sock is None:
+                    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self._sock.connect(self._socket_path)
+                try:
+                    send_message(self._sock, message)
+                    response = receive_message(self._sock)
+                except OSError:
+                    response = None
+                if response is not None:
+                    break
+                self._sock.close()
+                self._sock = None
+            else:
+                raise ConnectionError(f"Model server at {self._socket_path} closed the connection.")
+
+        if "error" in response:
+            raise RuntimeError(f"Model server error: {response['error']}")
+        return response
+
+    def run(self, input_text: str, prompt: Tuple[str, dict], history_dict: dict) -> Union[List[EntitySpan], Set[str], dict]:
+        """
+        Runs the model wrapper in the model server.
+
+        :param input_text: text to run the model wrapper on
+        :param prompt: The prompt key and body of the task
+        :param history_dict: dictionary to log the raw responses (None if they are not recorded)
+        :return: spans, a set of patterns or a dictionary of entity type -> set of patterns
+        """
+        response = self.request({"op": "run", "model_id": self._model_id, "input_text": input_text,
+                                 "prompt": [prompt[0], dict(prompt[1])], "with_responses": self._with_responses})
+        if history_dict is not None:
+            history_dict.update(response.get("responses", {}))
+
+        return decode_found_entities(response["found_entities"])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Host the models of AI-NER for multiple workers.')
+    parser.add_argument('--socket', default="/tmp/ai-ner.sock", help='path of the Unix socket')
+    args = parser.parse_args()
+
+    ModelServer(args.socket).serve_forever()
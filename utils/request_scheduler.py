@@ -0,0 +1,147 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class AdmissionError(Exception):
+    """
+    Raised if a request can't be finished before its deadline.
+    """
+
+
+class RequestScheduler:
+    PRIORITIES = {"interactive": 0, "bulk": 1}
+
+    def __init__(self, default_seconds_per_char: float = 0.001, smoothing: float = 0.2) -> None:
+        """
+        Runs the editing requests one after another in a background thread.
+        Interactive requests are preferred over bulk requests and within a priority class shorter jobs run first.
+        The runtime of a job is estimated from the observed latencies per task and character, a request is rejected
+        right away if its estimated queue and run time exceeds its deadline. Jobs with tasks that were never observed
+        are always admitted, their first run seeds the estimate.
+
+        :param default_seconds_per_char: Estimated latency of tasks without observations, only used to order and
+                                         account for queued jobs. It is replaced by the first observation of the task.
+        :param smoothing: Weight of a new observation in the exponential moving average of the latencies
+        """
+        self._default_seconds_per_char = default_seconds_per_char
+        self._smoothing = smoothing
+        self._seconds_per_char = dict()
+        self._queue = []
+        self._counter = itertools.count()
+        self._running = None
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="request-scheduler", daemon=True)
+        self._thread.start()
+
+    def estimate(self, configuration: List[str], num_chars: int) -> float:
+        """
+        Estimates the runtime of a job.
+
+        :param configuration: tasks of the job
+        :param num_chars: number of characters to edit
+        :return: estimated runtime in seconds
+        """
+        return sum(self._seconds_per_char.get(task, self._default_seconds_per_char) * num_chars
+                   for task in configuration)
+
+    def observed(self, configuration: List[str]) -> bool:
+        """
+        Returns whether the latencies of all tasks of a job have been observed, i.e. whether its estimate is reliable.
+
+        :param configuration: tasks of the job
+        :return: True if all tasks have been observed
+        """
+        return all(task in self._seconds_per_char for task in configuration)
+
+    def observe(self, task_latencies: Dict[str, Tuple[float, int]]) -> None:
+        """
+        Updates the latency estimates with the measured latencies of a job.
+
+        :param task_latencies: dictionary of task name -> (seconds, number of characters processed)
+        :return: None
+        """
+        for task, (seconds, num_chars) in task_latencies.items():
+            if num_chars == 0:
+                continue
+            seconds_per_char = seconds / num_chars
+            previous = self._seconds_per_char.get(task)
+            self._seconds_per_char[task] = seconds_per_char if previous is None else \
+                (1 - self._smoothing) * previous + self._smoothing * seconds_per_char
+
+    def _queued_time(self, key: tuple) -> float:
+        """
+        Estimated time until a job with the given key starts. Must be called holding the condition.
+
+        :param key: (priority, cost) of the job
+        :return: estimated waiting time in seconds
+        """
+        waiting_time = sum(entry[1] for entry in self._queue if entry[:2] <= key)
+        if self._running is not None:
+            cost, started = self._running
+            waiting_time += max(0.0, cost - (time.monotonic() - started))
+        return waiting_time
+
+    def submit(self, job: Callable, cost: float, priority: str = "interactive",
+               deadline_ms: Optional[int] = None, enforce_deadline: bool = True) -> asyncio.Future:
+        """
+        Queues a job.
+
+        :param job: function running the job
+        :param cost: estimated runtime of the job in seconds (see estimate)
+        :param priority: "interactive" or "bulk"
+        :param deadline_ms: time in milliseconds within which the job has to be finished
+        :param enforce_deadline: whether the job is rejected or shed if its deadline can't be met.
+                                 Should be False if the estimate is not reliable yet (see observed).
+        :return: awaitable result of the job
+        """
+        if priority not in self.PRIORITIES:
+            raise ValueError(f"priority must be one of {list(self.PRIORITIES)}, got {priority}")
+
+        key = (self.PRIORITIES[priority], cost)
+        future = Future()
+        with self._condition:
+            deadline = None
+            if deadline_ms is not None and enforce_deadline:
+                deadline = time.monotonic() + deadline_ms / 1000
+                estimated_time = self._queued_time(key) + cost
+                if estimated_time * 1000 > deadline_ms:
+                    raise AdmissionError(f"Estimated time of {estimated_time * 1000:.0f} ms exceeds "
+                                         f"the deadline of {deadline_ms} ms")
+
+            heapq.heappush(self._queue, (*key, next(self._counter), job, deadline, future))
+            self._condition.notify()
+
+        return asyncio.wrap_future(future)
+
+    def _run(self) -> None:
+        """
+        Runs the queued jobs.
+
+        :return: None
+        """
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                _, cost, _, job, deadline, future = heapq.heappop(self._queue)
+                if not future.set_running_or_notify_cancel():
+                    # the client is gone
+                    continue
+                if deadline is not None and time.monotonic() + cost > deadline:
+                    future.set_exception(AdmissionError("Deadline can't be met anymore, request was shed"))
+                    continue
+                self._running = (cost, time.monotonic())
+
+            try:
+                future.set_result(job())
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._condition:
+                    self._running = None
@@ -0,0 +1,121 @@
+import os
+import threading
+
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+
+class ResourceScheduler:
+    def __init__(self, total_threads: Optional[int] = None) -> None:
+        """
+        Partitions the CPU cores of the process between the loaded model wrappers.
+
+        Each wrapper gets a thread budget (and optionally a set of cores it is pinned to) and a cap on how many
+        inferences may run concurrently on it. Budgets are read from the model config via the keys
+        `n_threads`, `cpu_affinity` and `max_concurrency`. Wrappers without an explicit `n_threads` share
+        the remaining cores evenly.
+
+        :param total_threads: number of threads to distribute. Defaults to all cores available to the process.
+        """
+        if total_threads is None:
+            total_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        self._total_threads = max(1, total_threads or 1)
+        self._affinities = dict()
+        self._semaphores = dict()
+        self._wrappers = dict()
+
+    @staticmethod
+    def get_backend(model_class: type) -> Optional[str]:
+        """
+        Returns the compute backend of a model wrapper class ("llama", "torch" or None for pure python wrappers).
+
+        :param model_class: class of the model wrapper
+        :return: name of the backend
+        """
+        return getattr(model_class, "BACKEND", None)
+
+    def partition(self, wrappers: Dict[str, tuple]) -> Dict[str, dict]:
+        """
+        Registers (or replaces) wrappers and assigns a thread budget to every registered wrapper.
+        The cores are always split between all registered wrappers, so budgets of wrappers that are already loaded
+        may shrink when new ones are added and have to be re-applied (see the `set_threads` hook of the wrappers).
+
+        :param wrappers: dictionary of model name -> (model class, params) of the wrappers to register
+        :return: dictionary of model name -> params including `n_threads` and `n_threads_batch`
+                 for all registered wrappers
+        """
+        for name, (model_class, params) in wrappers.items():
+            self._wrappers[name] = (model_class, dict(params))
+            max_concurrency = params.get("max_concurrency", 1 if self.get_backend(model_class) == "llama" else None)
+            if max_concurrency:
+                self._semaphores[name] = threading.BoundedSemaphore(max_concurrency)
+            else:
+                self._semaphores.pop(name, None)
+            if params.get("cpu_affinity"):
+                self._affinities[name] = set(params["cpu_affinity"])
+            else:
+                self._affinities.pop(name, None)
+
+        threaded = {name: params for name, (model_class, params) in self._wrappers.items()
+                    if self.get_backend(model_class) is not None}
+        reserved = sum(params["n_threads"] for params in threaded.values() if "n_threads" in params)
+        unassigned = [name for name, params in threaded.items() if "n_threads" not in params]
+        share = max(1, (self._total_threads - reserved) // len(unassigned)) if unassigned else 0
+
+        torch_threads = 0
+        partitioned = dict()
+        for name, (model_class, params) in self._wrappers.items():
+            params = dict(params)
+            if name in threaded:
+                params.setdefault("n_threads", share)
+                params.setdefault("n_threads_batch", params["n_threads"])
+                if self.get_backend(model_class) == "torch":
+                    torch_threads += params["n_threads"]
+
+            partitioned[name] = params
+
+        if torch_threads:
+            # torch has a single intra-op pool per process that is shared by all torch based wrappers
+            import torch
+            torch.set_num_threads(torch_threads)
+
+        return partitioned
+
+    def remove(self, model_name: str) -> None:
+        """
+        Unregisters a wrapper, its cores are handed to the remaining wrappers on the next partition.
+
+        :param model_name: name of the model wrapper
+        :return: None
+        """
+        self._wrappers.pop(model_name, None)
+        self._semaphores.pop(model_name, None)
+        self._affinities.pop(model_name, None)
+
+    @contextmanager
+    def slot(self, model_name: str):
+        """
+        Context manager that waits for a free inference slot of the wrapper and pins the calling thread to the cores
+        configured for the wrapper. Only threads the calling thread creates while it is pinned inherit the affinity,
+        worker threads of persistent pools (the intra-op pool of torch, the thread pool of newer llama.cpp versions)
+        are not moved, so for these backends `cpu_affinity` only bounds the calling thread.
+
+        :param model_name: name of the model wrapper
+        :return: None
+        """
+        semaphore = self._semaphores.get(model_name)
+        affinity = self._affinities.get(model_name)
+        previous_affinity = None
+
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            if affinity and hasattr(os, "sched_setaffinity"):
+                previous_affinity = os.sched_getaffinity(0)
+                os.sched_setaffinity(0, affinity)
+            yield
+        finally:
+            if previous_affinity is not None:
+                os.sched_setaffinity(0, previous_affinity)
+            if semaphore is not None:
+                semaphore.release()
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from sqlitedict import SqliteDict
+from typing import Optional, Set, Tuple
+from utils.file_processing import file_hash
+
+
+class ResponseCache:
+    def __init__(self, file_name: str = "data/cache/llm_responses.sqlite", max_entries: int = 100000,
+                 flush_every: int = 1000) -> None:
+        """
+        Persistent cache of LLM responses, keyed by the model file, the sampling parameters and the prompt.
+        If the cache grows beyond max_entries, the least recently used tenth of the entries is evicted.
+        Access times are kept in their own table and written in batches, so a cache hit doesn't write to disk.
+
+        :param file_name: Name of the SQLite file
+        :param max_entries: Maximum number of cached responses
+        :param flush_every: Number of cache hits after which the access times are written
+        """
+        directory = os.path.dirname(file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._max_entries = max_entries
+        self._responses = SqliteDict(file_name, tablename="responses", autocommit=True)
+        self._file_hashes = SqliteDict(file_name, tablename="file_hashes", autocommit=True)
+        self._access_times = SqliteDict(file_name, tablename="access_times", autocommit=True)
+        self._pending_access_times = dict()
+        self._flush_every = flush_every
+        self._size = len(self._responses)
+        self._lock = threading.Lock()
+
+    def file_hash(self, file_name: str) -> str:
+        """
+        Returns the sha256 hash of a (model) file. The hash is memoized by path, size and modification time,
+        so the file is only read once.
+
+        :param file_name: Name of the file
+        :return: hex digest of the file
+        """
+        stat = os.stat(file_name)
+        stat_key = f"{os.path.abspath(file_name)}:{stat.st_size}:{stat.st_mtime_ns}"
+        if stat_key not in self._file_hashes:
+            self._file_hashes[stat_key] = file_hash(file_name)
+
+        return self._file_hashes[stat_key]
+
+    @staticmethod
+    def make_key(model_hash: str, params: dict, prompt: str) -> str:
+        """
+        Builds the cache key of a request.
+
+        :param model_hash: hash of the model file
+        :param params: sampling parameters of the request
+        :param prompt: full prompt string
+        :return: cache key
+        """
+        request = json.dumps([model_hash, params, prompt], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[Set[str], str]]:
+        """
+        Returns a cached response.
+
+        :param key: cache key
+        :return: found entities and response text or None if the key is not cached
+        """
+        with self._lock:
+            entry = self._responses.get(key)
+            if entry is None:
+                return None
+
+            self._pending_access_times[key] = time.time()
+            if len(self._pending_access_times) >= self._flush_every:
+                self.flush_access_times()
+
+        return set(entry["entities"]), entry["response_text"]
+
+    def put(self, key: str, found_entities: Set[str], response_text: str) -> None:
+        """
+        Caches a response and evicts the least recently used entries if the cache is full.
+
+        :param key: cache key
+        :param found_entities: entities parsed from the response
+        :param response_text: raw response text of the LLM
+        :return: None
+        """
+        with self._lock:
+            if key not in self._responses:
+                self._size += 1
+            self._responses[key] = {"entities": list(found_entities), "response_text": response_text}
+            self._pending_access_times[key] = time.time()
+
+            if self._size > self._max_entries:
+                self.evict(self._max_entries - self._max_entries // 10)
+
+    def flush_access_times(self) -> None:
+        """
+        Writes the pending access times in a single transaction. Must be called holding the lock.
+
+        :return: None
+        """
+        if self._pending_access_times:
+            self._access_times.update(self._pending_access_times)
+            self._pending_access_times.clear()
+
+    def evict(self, max_entries: int) -> None:
+        """
+        Deletes the least recently used entries until at most max_entries are left. Must be called holding the lock.
+
+        :param max_entries: number of entries to keep
+        :return: None
+        """
+        self.flush_access_times()
+        access_times = dict(self._access_times.items())
+        keys = sorted(self._responses.keys(), key=lambda key: access_times.get(key, 0.0))
+        for key in keys[:max(0, len(keys) - max_entries)]:
+            del self._responses[key]
+            if key in access_times:
+                del self._access_times[key]
+
+        self._size = len(self._responses)
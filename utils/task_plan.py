@@ -0,0 +1,303 @@
+import importlib
+import os
+import threading
+
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Dict, FrozenSet, Mapping, NamedTuple, Optional, Tuple, Union
+
+from utils.couch_db_handler import CouchDBHandler
+from utils.file_processing import read_yml
+from utils.model_server import RemoteModelWrapper, request_once
+from utils.resource_scheduler import ResourceScheduler
+
+
+class CompiledTask(NamedTuple):
+    """
+    A validated task of a plan. The prompt is passed to the model wrapper as is, its body is read-only and holds
+    the task config together with the values precompiled by the wrapper (e.g. regexes or prompt prefixes).
+    If languages is given, the task only runs on text of these languages.
+    """
+    name: str
+    model_key: str
+    prompt: Tuple[str, Mapping]
+    replace_token: Union[str, Mapping]
+    languages: Optional[FrozenSet[str]] = None
+
+
+class TaskPlan(NamedTuple):
+    """
+    Immutable execution plan of a set of tasks.
+
+    tasks: the tasks in configuration order, which is the priority order of overlapping entities
+    model_wrappers: model key -> loaded model wrapper
+    groups: model key -> indices of the tasks using that model, to run tasks of the same model one after another
+    revisions: (task name, task revision, model config, model revision) per task, identifies the configs the plan was
+               compiled from
+    """
+    tasks: Tuple[CompiledTask, ...]
+    model_wrappers: Mapping
+    groups: Mapping
+    revisions: Tuple[tuple, ...] = ()
+
+
+class TaskPlanCompiler:
+    def __init__(self, config_model_db: Optional[CouchDBHandler], scheduler: Optional[ResourceScheduler] = None,
+                 model_server: Optional[str] = None, max_plans: int = 32, with_responses: bool = False) -> None:
+        """
+        Compiles task configurations into validated execution plans. Plans are cached by the task names and the
+        revisions of the task and model configs, the loaded model wrappers are shared between plans.
+
+        :param config_model_db: db table where model configs are stored.
+                                If None, then model_config better be a yaml file.
+        :param scheduler: scheduler that partitions the CPU between the model wrappers
+        :param model_server: path of the Unix socket of a model server (see utils/model_server.py).
+                             Wrappers with a backend are then resolved, compiled and loaded in the model server,
+                             so their modules (torch, flair, llama.cpp, ...) are never imported in this process.
+        :param max_plans: Maximum number of cached plans
+        :param with_responses: whether wrappers in the model server send back their raw responses
+                               (only needed for the full history)
+        """
+        self._config_model_db = config_model_db
+        self._scheduler = scheduler if scheduler is not None else ResourceScheduler()
+        self._model_server = model_server
+        self._max_plans = max_plans
+        self._with_responses = with_responses
+        self._plans = OrderedDict()
+        self._model_wrappers = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def resolve_model_class(task_name: str, model_wrapper: str) -> type:
+        """
+        Imports the model wrapper class of a task.
+
+        :param task_name: name of the task (for error messages)
+        :param model_wrapper: model wrapper as "module/class", e.g. "ner_model/FlairModel"
+        :return: model wrapper class
+        """
+        module_name, model_name = model_wrapper.split("/")
+        try:
+            module = importlib.import_module("model_wrapper." + module_name)
+        except ModuleNotFoundError as e:
+            raise ValueError(f"Task {task_name}: model wrapper module {module_name} can't be imported ({e})")
+        if not hasattr(module, model_name):
+            raise ValueError(f"Task {task_name}: model wrapper {model_name} does not exist in {module_name}")
+
+        return getattr(module, model_name)
+
+    def load_model_params(self, model_config: Optional[str]) -> dict:
+        """
+        Loads the params of a model config from a yaml file or the db.
+
+        :param model_config: name of the model config or path of a yaml file
+        :return: params of the model
+        """
+        if not model_config:
+            return dict()
+        if model_config.endswith(".yaml"):
+            return read_yml(model_config)
+        return dict(self._config_model_db.get_config(model_config))
+
+    def fetch_model_config(self, model_config: Optional[str]) -> Tuple[Optional[str], Optional[dict]]:
+        """
+        Fetches the revision of a model config (the couchdb revision or the modification time of the yaml file)
+        together with the config itself if it is stored in the db, so each model config is requested once per compile.
+
+        :param model_config: name of the model config or path of a yaml file
+        :return: revision and params of the model (None for yaml files, they are only read when the model is loaded)
+        """
+        if not model_config:
+            return None, dict()
+        if model_config.endswith(".yaml"):
+            if not os.path.exists(model_config):
+                raise ValueError(f"Model config {model_config} does not exist")
+            return str(os.path.getmtime(model_config)), None
+        if self._config_model_db is None:
+            raise ValueError(f"Model config {model_config} does not exist")
+        try:
+            params = dict(self._config_model_db.get_config(model_config))
+        except Exception as e:
+            raise ValueError(f"Model config {model_config} can't be loaded ({e})")
+        return params.get("_rev"), params
+
+    def compile_task(self, task_name: str, task_config: dict) -> Tuple[CompiledTask, Optional[type]]:
+        """
+        Validates a task config and precompiles it.
+
+        :param task_name: name of the task
+        :param task_config: config of the task
+        :return: compiled task and its model wrapper class (None if the wrapper is served by the model server)
+        """
+        model = task_config.get("model")
+        if not isinstance(model, dict) or "model_wrapper" not in model:
+            raise ValueError(f"Task {task_name}: model.model_wrapper is missing")
+        model_wrapper = model["model_wrapper"]
+        if not isinstance(model_wrapper, str) or len(model_wrapper.split("/")) != 2:
+            raise ValueError(f"Task {task_name}: model_wrapper must be given as 'module/class', got {model_wrapper}")
+        replace_token = task_config.get("replace_token")
+        if not isinstance(replace_token, (str, dict)):
+            raise ValueError(f"Task {task_name}: replace_token must be a string or a dictionary of entity types")
+        languages = task_config.get("languages")
+        if languages is not None:
+            if not isinstance(languages, list) or not all(isinstance(language, str) for language in languages):
+                raise ValueError(f"Task {task_name}: languages must be a list of language codes, e.g. ['de']")
+            languages = frozenset(languages)
+
+        remote = None
+        if self._model_server:
+            remote = request_once(self._model_server, {"op": "compile", "model_wrapper": model_wrapper,
+                                                       "task_name": task_name, "task_config": task_config})
+            if "invalid" in remote:
+                raise ValueError(f"Task {task_name}: {remote['invalid']}")
+
+        if remote is not None and remote["backend"] is not None:
+            model_class = None
+            compiled = remote["compiled"]
+            labels = remote["labels"]
+        else:
+            model_class = self.resolve_model_class(task_name, model_wrapper)
+            compiled = dict()
+            if hasattr(model_class, "compile_task"):
+                try:
+                    compiled = model_class.compile_task(task_config)
+                except ValueError as e:
+                    raise ValueError(f"Task {task_name}: {e}")
+            labels = model_class.labels(task_name, task_config) if hasattr(model_class, "labels") else None
+
+        missing_labels = set(labels or []) - set(replace_token) if isinstance(replace_token, dict) else set()
+        if missing_labels:
+            raise ValueError(f"Task {task_name}: replace_token has no token for {sorted(missing_labels)}, "
+                             f"give a token for each of them or a single string")
+
+        model_key = f"{model_wrapper}:{model.get('model_config') or ''}"
+        prompt_body = MappingProxyType({**task_config, **compiled})
+        replace_token = replace_token if isinstance(replace_token, str) else MappingProxyType(dict(replace_token))
+
+        return CompiledTask(task_name, model_key, (task_name, prompt_body), replace_token, languages), model_class
+
+    def fetch_revisions(self, config: Dict[str, dict]) -> Tuple[tuple, dict]:
+        """
+        Returns the revisions a plan of the task configs is identified by (see TaskPlan.revisions).
+
+        :param config: dictionary of task name -> task config, in priority order
+        :return: revisions and the fetched model configs (model config -> (revision, params), see fetch_model_config)
+        """
+        model_configs = dict()
+        revisions = []
+        for task_name, task_config in config.items():
+            model = task_config.get("model")
+            model_config = model.get("model_config") if isinstance(model, dict) else None
+            if model_config not in model_configs:
+                model_configs[model_config] = self.fetch_model_config(model_config)
+            revisions.append((task_name, task_config.get("_rev"), model_config, model_configs[model_config][0]))
+        return tuple(revisions), model_configs
+
+    def compile(self, config: Dict[str, dict]) -> TaskPlan:
+        """
+        Returns the (cached) execution plan of the task configs.
+
+        :param config: dictionary of task name -> task config, in priority order
+        :return: execution plan
+        """
+        revisions, model_configs = self.fetch_revisions(config)
+
+        with self._lock:
+            if revisions in self._plans:
+                self._plans.move_to_end(revisions)
+                return self._plans[revisions]
+
+            tasks = []
+            groups = OrderedDict()
+            new_models = dict()
+            for (task_name, task_config), (_, _, model_config, model_revision) in zip(config.items(), revisions):
+                task, model_class = self.compile_task(task_name, task_config)
+                tasks.append(task)
+                groups.setdefault(task.model_key, []).append(len(tasks) - 1)
+
+                cached = self._model_wrappers.get(task.model_key)
+                if (cached is None or cached[0] != model_revision) and task.model_key not in new_models:
+                    params = model_configs[model_config][1]
+                    params = dict(params) if params is not None else self.load_model_params(model_config)
+                    new_models[task.model_key] = (model_class, params, model_revision, task_config["model"])
+
+            self.evict_model_wrappers([model_key for model_key in new_models if model_key in self._model_wrappers])
+            self.load_model_wrappers(new_models)
+
+            plan = TaskPlan(tuple(tasks),
+                            MappingProxyType({model_key: self._model_wrappers[model_key][1] for model_key in groups}),
+                            MappingProxyType({model_key: tuple(indices) for model_key, indices in groups.items()}),
+                            revisions)
+
+            self._plans[revisions] = plan
+            while len(self._plans) > self._max_plans:
+                self._plans.popitem(last=False)
+            self.release_unused_model_wrappers()
+
+        return plan
+
+    def evict_model_config(self, model_config: str) -> None:
+        """
+        Drops the model wrappers of a model config (e.g. when it is deleted) and the cached plans referencing them.
+
+        :param model_config: name of the model config or path of a yaml file
+        :return: None
+        """
+        with self._lock:
+            self.evict_model_wrappers([model_key for model_key in self._model_wrappers
+                                       if model_key.split(":", 1)[1] == model_config])
+            self.release_unused_model_wrappers()
+
+    def release_unused_model_wrappers(self) -> None:
+        """
+        Drops the model wrappers that no cached plan references anymore and hands their cores to the remaining
+        wrappers. Must be called holding the lock.
+
+        :return: None
+        """
+        used = {model_key for plan in self._plans.values() for model_key in plan.model_wrappers}
+        unused = [model_key for model_key in self._model_wrappers if model_key not in used]
+        if unused:
+            self.evict_model_wrappers(unused)
+            self.load_model_wrappers(dict())
+
+    def evict_model_wrappers(self, model_keys: list) -> None:
+        """
+        Drops outdated model wrappers together with the cached plans referencing them, so their memory is freed
+        before the new revisions are loaded. Must be called holding the lock.
+
+        :param model_keys: model keys of the wrappers to drop
+        :return: None
+        """
+        for revisions in [revisions for revisions, plan in self._plans.items()
+                          if any(model_key in plan.model_wrappers for model_key in model_keys)]:
+            del self._plans[revisions]
+        for model_key in model_keys:
+            del self._model_wrappers[model_key]
+            self._scheduler.remove(model_key)
+
+    def load_model_wrappers(self, new_models: dict) -> None:
+        """
+        Loads model wrappers (locally or in the model server) and caches them. The cores are partitioned again
+        between all local wrappers and the new budgets are applied to the wrappers that are already loaded.
+
+        :param new_models: dictionary of model key -> (model class or None if served by the model server, params,
+                           revision, model config of the task)
+        :return: None
+        """
+        local_models = dict()
+        for model_key, (model_class, params, model_revision, model) in new_models.items():
+            if model_class is None:
+                wrapper = RemoteModelWrapper(self._model_server, model["model_wrapper"], model.get("model_config") or "",
+                                             params, self._with_responses)
+                self._model_wrappers[model_key] = (model_revision, wrapper)
+            else:
+                local_models[model_key] = (model_class, params)
+
+        partitioned_params = self._scheduler.partition(local_models)
+        for model_key, params in partitioned_params.items():
+            if model_key in local_models:
+                model_class = local_models[model_key][0]
+                self._model_wrappers[model_key] = (new_models[model_key][2], model_class(params))
+            elif "n_threads" in params and hasattr(self._model_wrappers[model_key][1], "set_threads"):
+                self._model_wrappers[model_key][1].set_threads(params["n_threads"], params["n_threads_batch"])
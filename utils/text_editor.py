@@ -1,45 +1,65 @@
-import importlib
-import numpy as np
+import bisect
+import re
+import time
 import json
-import yaml
 
+from model_wrapper.abstract_model_wrapper import AbstractNERModel, EntitySpan
 from utils.couch_db_handler import CouchDBHandler
+from utils.file_processing import read_yml
+from utils.history_writer import HistoryWriter
+from utils.language_detection import UNKNOWN, language_at, language_segments
+from utils.resource_scheduler import ResourceScheduler
+from utils.task_plan import CompiledTask, TaskPlan, TaskPlanCompiler
 from collections import OrderedDict
-from typing import Dict, Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 
 class Editor:
-    def __init__(self, config: Union[str, dict], config_model_db: Union[CouchDBHandler, None]):
+    HISTORY_LEVELS = ["off", "patterns", "full"]
+
+    def __init__(self, config: Union[str, dict, TaskPlan], config_model_db: Union[CouchDBHandler, None],
+                 scheduler: Optional[ResourceScheduler] = None, history_level: str = "off",
+                 history_writer: Optional[HistoryWriter] = None, model_server: Optional[str] = None,
+                 language_granularity: str = "document"):
         """
         Class to edit input text by using a Language Model.
-        :param config: path to config file that defines location of config files
+        :param config: path to config file that defines location of config files, the dictionary of task configs
+                       or an already compiled task plan
         :param config_model_db: db table where model configs are stored.
                                 If None, then model_config better be a yaml file.
+        :param scheduler: scheduler that partitions the CPU between the model wrappers.
+                          If None, a new scheduler over all available cores is created.
+        :param history_level: "off" (no history), "patterns" (found patterns and edits against the input) or
+                              "full" (additionally the input text and the raw model responses)
+        :param history_writer: writer the history record of each edited text is sent to (if history is not off)
+        :param model_server: path of the Unix socket of a model server. If given, all models with weights
+                             are loaded once in the model server process instead of in this process.
+        :param language_granularity: "document" or "paragraph", the level on which the language is detected for
+                                     tasks with a `languages` filter
         """
-        if type(config) == str:
-            self._prompts = self.load_yml(config)
+        if history_level not in self.HISTORY_LEVELS:
+            raise ValueError(f"history_level must be one of {self.HISTORY_LEVELS}, got {history_level}")
+        self._history_level = history_level
+        self._history_writer = history_writer
+
+        self._scheduler = scheduler if scheduler is not None else ResourceScheduler()
+
+        if isinstance(config, TaskPlan):
+            self._plan = config
         else:
-            self._prompts = config
-
-        self._model_wrappers = dict()
-        for prompt_name, prompt_dict in self._prompts.items():
-            model = prompt_dict["model"]
-            module_name = model["model_wrapper"].split("/")[0]
-            model_name = model["model_wrapper"].split("/")[1]
-            param_filename = model.get("model_config", None)
-            
-            if param_filename and param_filename.endswith(".yaml"):
-                params = self.load_yml(param_filename)
-            else:
-                params = config_model_db.get_config(param_filename) if param_filename else {}
-
-            if model_name in self._model_wrappers.keys():
-                continue
+            prompts = self.load_yml(config) if type(config) == str else config
+            self._plan = TaskPlanCompiler(config_model_db, self._scheduler, model_server,
+                                          with_responses=history_level == "full").compile(prompts)
 
-            module = importlib.import_module("model_wrapper." + module_name)
-            self._model_wrappers[model_name] = getattr(module, model_name)(params)
+        if language_granularity not in ["document", "paragraph"]:
+            raise ValueError(f"language_granularity must be document or paragraph, got {language_granularity}")
+        self._language_granularity = language_granularity
+        self._language_routing = any(task.languages is not None for task in self._plan.tasks)
+        self._routed_languages = frozenset().union(*[task.languages for task in self._plan.tasks
+                                                     if task.languages is not None])
 
         self._history_dict = OrderedDict()
+        self._task_latencies = dict()
 
     @staticmethod
     def load_yml(configfile: str) -> Dict:
@@ -48,12 +68,7 @@ class Editor:
         :param configfile: Path to the YAML config file.
         :return: A dictionary containing the configuration data.
         """
-        with open(configfile, "r") as b:
-            try:
-                data = yaml.safe_load(b)
-            except yaml.YAMLError as err:
-                print(err)
-        return data
+        return read_yml(configfile)
 
     @staticmethod
     def load_json(configfile: str) -> Dict:
@@ -69,60 +84,281 @@ class Editor:
                 print(err)
         return data
 
-    def save_history(self, file_name: str):
+    @property
+    def plan(self) -> TaskPlan:
         """
-        Saves the history dictionary containing all edits to the input text.
-        :param file_name: Name of file where to save the history
-        :return: None
+        Returns the execution plan of the editor.
+        :return: task plan
         """
-        with open(file_name, "w+", encoding="utf8") as f:
-            f.write(json.dumps(self._history_dict,
-                               indent=4,
-                               ensure_ascii=False,
-                               default=lambda x: float(x) if isinstance(x, (float, np.float32)) else None
-                               ))
-        
-        self._history_dict = OrderedDict()
+        return self._plan
+
+    @property
+    def history(self) -> dict:
+        """
+        Returns the history record of the last edited text (empty if the history level is off).
+        :return: history record
+        """
+        return self._history_dict
+
+    def pop_task_latencies(self) -> Dict[str, Tuple[float, int]]:
+        """
+        Returns the time spent per task since the last call, together with the number of characters processed.
+        :return: dictionary of task name -> (seconds, number of characters)
+        """
+        task_latencies, self._task_latencies = self._task_latencies, dict()
+        return task_latencies
 
     @staticmethod
-    def replace_patterns(unique_patterns: Set[str], text: str, replace_token: str) -> str:
+    def find_patterns(unique_patterns: Set[str], text: str, label: str) -> List[EntitySpan]:
         """
-        Replaces all patterns with given replace token.
-        :param unique_patterns: patterns to be replaced.
-        :param text: text string in which to replace the pattern
-        :param replace_token: token which replaces the pattern
-        :return: edited text
+        Locates all occurrences of the patterns in the text in a single scan.
+        Used for model wrappers that only return the surface strings of the entities (e.g. the LLM).
+        :param unique_patterns: patterns to be located.
+        :param text: text string in which to locate the patterns
+        :param label: label of the returned spans
+        :return: spans of all occurrences
         """
+        unique_patterns = set(unique_patterns)
         unique_patterns.discard("FAILED")
         unique_patterns.discard("")
-        output_text = text
-        for pattern in unique_patterns:
-            output_text = output_text.replace(pattern, replace_token)
+        if not unique_patterns:
+            return []
+
+        # longer patterns first, so that "Christian Mayer" wins over "Christian"
+        regex = re.compile("|".join(map(re.escape, sorted(unique_patterns, key=len, reverse=True))))
+        return [EntitySpan(match.start(), match.end(), match.group(0), label) for match in regex.finditer(text)]
+
+    def to_edits(self, found_entities: Union[List[EntitySpan], Set[str], dict], text: str,
+                 task: CompiledTask) -> List[Tuple[EntitySpan, str]]:
+        """
+        Converts the output of a model wrapper into a list of (span, replace token) edits on the text.
+        :param found_entities: spans, a set of patterns or a dictionary of entity type -> set of patterns
+        :param text: text string the model wrapper ran on
+        :param task: the compiled task
+        :return: edits sorted by start offset (longer spans first)
+        """
+        replace_token = task.replace_token
+        if type(found_entities) is dict:
+            spans = [span for entity_type, entities in found_entities.items()
+                     for span in self.find_patterns(entities, text, entity_type)]
+        elif isinstance(found_entities, list):
+            spans = found_entities
+        else:
+            spans = self.find_patterns(found_entities, text, task.name)
+
+        edits = [(span, replace_token if isinstance(replace_token, str) else replace_token[span.label])
+                 for span in spans]
+        return sorted(edits, key=lambda edit: (edit[0].start, edit[0].start - edit[0].end))
+
+    @staticmethod
+    def replace_spans(text: str, edits: List[Tuple[EntitySpan, str]]) -> Tuple[str, List[Tuple[EntitySpan, str]]]:
+        """
+        Replaces the spans with their replace tokens in a single pass over the text.
+        Edits are given in priority order, an edit overlapping an earlier edit is dropped.
+        :param text: text string to be edited
+        :param edits: (span, replace token) tuples in priority order
+        :return: edited text and the applied edits sorted by offset
+        """
+        starts = []
+        applied = []
+        for span, replace_token in edits:
+            i = bisect.bisect_left(starts, span.start)
+            if i > 0 and applied[i - 1][0].end > span.start:
+                continue
+            if i < len(applied) and applied[i][0].start < span.end:
+                continue
+            starts.insert(i, span.start)
+            applied.insert(i, (span, replace_token))
+
+        output_text = []
+        cursor = 0
+        for span, replace_token in applied:
+            output_text.append(text[cursor:span.start])
+            output_text.append(replace_token)
+            cursor = span.end
+        output_text.append(text[cursor:])
+
+        return "".join(output_text), applied
+
+    def run_task(self, task: CompiledTask, text: str,
+                 responses: Optional[dict]) -> Union[List[EntitySpan], Set[str], dict]:
+        """
+        Runs the model wrapper of a task on the text.
+        :param task: the compiled task
+        :param text: text string to run the model wrapper on
+        :param responses: dictionary to log the raw responses of the model wrapper (None if they are not recorded)
+        :return: spans, a set of patterns or a dictionary of entity type -> set of patterns
+        """
+        model_wrapper = self._plan.model_wrappers[task.model_key]
+        start = time.perf_counter()
+        with self._scheduler.slot(task.model_key):
+            found_entities = model_wrapper.run(text, task.prompt, responses)
+
+        seconds, num_chars = self._task_latencies.get(task.name, (0.0, 0))
+        self._task_latencies[task.name] = (seconds + time.perf_counter() - start, num_chars + len(text))
+
+        return found_entities
+
+    def run_tasks(self, text: str, responses: Optional[dict],
+                  segments: Optional[List[Tuple[int, str, str]]] = None) -> Dict[str, Union[List[EntitySpan], Set[str], dict]]:
+        """
+        Runs all tasks on the text, the tasks of the same model one after another.
+        Tasks with a `languages` filter only run on the segments of the text in one of these languages.
+        If the language of a segment is unknown (e.g. too short or not detected with enough confidence) or matches
+        none of the filtered tasks, all filtered tasks run on it, so that no entities are missed.
+        :param text: text string to run the tasks on
+        :param responses: dictionary to log the raw responses of the model wrappers (None if they are not recorded)
+        :param segments: (offset, segment, language) tuples of the text. Detected if needed and not given.
+        :return: output of the model wrapper per task name
+        """
+        if self._language_routing and segments is None:
+            segments = language_segments(text, self._language_granularity)
+
+        found_per_task = dict()
+        for indices in self._plan.groups.values():
+            for i in indices:
+                task = self._plan.tasks[i]
+                if task.languages is None:
+                    found_per_task[task.name] = self.run_task(task, text, responses)
+                    continue
+
+                found_entities = None
+                for offset, segment, language in segments:
+                    if language in task.languages or language == UNKNOWN or language not in self._routed_languages:
+                        found_entities = self.merge_found_entities(found_entities,
+                                                                   self.run_task(task, segment, responses), offset)
+                found_per_task[task.name] = found_entities if found_entities is not None else []
+        return found_per_task
+
+    @staticmethod
+    def merge_found_entities(total: Union[List[EntitySpan], Set[str], dict, None],
+                             found_entities: Union[List[EntitySpan], Set[str], dict],
+                             offset: int) -> Union[List[EntitySpan], Set[str], dict]:
+        """
+        Merges the output of a model wrapper on a sentence into the output for the whole text.
+        :param total: merged output so far (None for the first sentence), it is updated in place
+        :param found_entities: output of the model wrapper on the sentence
+        :param offset: offset of the sentence in the text
+        :return: merged output
+        """
+        if type(found_entities) is dict:
+            total = total if total is not None else dict()
+            for entity_type, entities in found_entities.items():
+                total[entity_type] = total.get(entity_type, set()) | set(entities)
+        elif isinstance(found_entities, list):
+            total = total if total is not None else []
+            total.extend(span.shift(offset) for span in found_entities)
+        else:
+            total = total if total is not None else set()
+            total.update(found_entities)
+        return total
+
+    def apply_found_entities(self, input_text: str, found_per_task: Dict[str, Union[List[EntitySpan], Set[str], dict]],
+                             responses: Optional[dict]) -> str:
+        """
+        Replaces the found entities of all tasks in one pass by their offsets.
+        On overlapping entities, the task listed first in the configuration wins.
+        :param input_text: Input text to be edited
+        :param found_per_task: output of the model wrapper per task
+        :param responses: raw responses of the model wrappers
+        :return: Edited input text
+        """
+        patterns = dict()
+        edits = []
+        for task in self._plan.tasks:
+            task_edits = self.to_edits(found_per_task[task.name], input_text, task)
+            if self._history_level != "off":
+                patterns[task.name] = list(dict.fromkeys(span.text for span, _ in task_edits))
+            edits.extend(task_edits)
+
+        output_text, applied = self.replace_spans(input_text, edits)
+        self.historize(input_text, patterns, applied, responses)
+
         return output_text
 
     def edit_text(self, input_text: str) -> str:
         """
         Edits the input text based on instructions provided in the configuration file.
+        All tasks run on the input text, the found entities are then replaced in one pass by their offsets.
         :param input_text: Input text to be edited
         :return: Edited input text
         """
+        responses = self.new_responses()
+        found_per_task = self.run_tasks(input_text, responses)
+
+        return self.apply_found_entities(input_text, found_per_task, responses)
+
+    def new_responses(self) -> Optional[dict]:
+        """
+        Returns the dictionary the model wrappers log their raw responses to. The raw responses are only
+        recorded for the full history, otherwise None is passed and the wrappers skip logging them.
+        :return: empty dictionary or None
+        """
+        return dict() if self._history_level == "full" else None
+
+    @staticmethod
+    def new_characters(input_text: str, previous_segments: dict) -> int:
+        """
+        Counts the characters of the sentences that edit_text_incremental has to run the tasks on.
+        :param input_text: Input text to be edited
+        :param previous_segments: dictionary of sentence -> found entities per task of the previous version
+        :return: number of characters of the new sentences
+        """
+        new_sentences = {sentence for _, sentence in AbstractNERModel.sentence_offsets(input_text)
+                         if sentence not in previous_segments}
+        return sum(map(len, new_sentences))
+
+    def edit_text_incremental(self, input_text: str, previous_segments: dict) -> Tuple[str, dict]:
+        """
+        Edits a new version of a previously edited text. The text is split into sentences and the tasks only run on
+        sentences that are not contained in the previous version, the found entities of all other sentences are reused.
+        :param input_text: Input text to be edited
+        :param previous_segments: dictionary of sentence -> found entities per task of the previous version
+        :return: Edited input text and the segments of this version
+        """
+        responses = self.new_responses()
+        segments = dict()
+        found_per_task = dict.fromkeys(task.name for task in self._plan.tasks)
+        languages = language_segments(input_text, self._language_granularity) if self._language_routing else None
+        for offset, sentence in AbstractNERModel.sentence_offsets(input_text):
+            if sentence not in segments:
+                segment = previous_segments.get(sentence)
+                if segment is None:
+                    sentence_language = [(0, sentence, language_at(languages, offset))] if languages else None
+                    segment = self.run_tasks(sentence, responses, sentence_language)
+                segments[sentence] = segment
+
+            for prompt_name, found_entities in segments[sentence].items():
+                found_per_task[prompt_name] = self.merge_found_entities(found_per_task[prompt_name],
+                                                                        found_entities, offset)
+
+        found_per_task = {prompt_name: found_entities if found_entities is not None else []
+                          for prompt_name, found_entities in found_per_task.items()}
+        output_text = self.apply_found_entities(input_text, found_per_task, responses)
+
+        return output_text, segments
+
+    def historize(self, input_text: str, patterns: Dict[str, List[str]], applied: List[Tuple[EntitySpan, str]],
+                  responses: Optional[dict]) -> None:
+        """
+        Records the history of the last edited text according to the history level and sends it to the writer.
+        The edits are stored as [start, end, replace token] against the input text instead of text copies.
+        :param input_text: Input text that was edited
+        :param patterns: found patterns per task
+        :param applied: applied (span, replace token) edits
+        :param responses: raw responses of the model wrappers
+        :return: None
+        """
         self._history_dict = OrderedDict()
-        self._history_dict["input_text"] = input_text
-        for prompt in self._prompts.items():
-            output_text = list(self._history_dict.values())[-1]
-            model_name = prompt[1]["model"]["model_wrapper"].split("/")[-1]
-
-            run_model_wrapper = getattr(self._model_wrappers[model_name], "run")
-            unique_patterns = run_model_wrapper(output_text, prompt, self._history_dict)
-
-            if type(unique_patterns) is dict:
-                self._history_dict[f"{prompt[0]}_patterns"] = list(set.union(*list(unique_patterns.values())))
-                for entity_type, entities in unique_patterns.items():
-                    output_text = self.replace_patterns(entities, output_text, prompt[1]["replace_token"][entity_type])
-            else:
-                self._history_dict[f"{prompt[0]}_patterns"] = list(unique_patterns)
-                output_text = self.replace_patterns(unique_patterns, output_text, prompt[1]["replace_token"])
-    
-            self._history_dict[f"{prompt[0]}_output_text"] = output_text
-
-        return list(self._history_dict.values())[-1]
+        if self._history_level == "off":
+            return
+
+        if self._history_level == "full":
+            self._history_dict["input_text"] = input_text
+        self._history_dict["patterns"] = patterns
+        self._history_dict["edits"] = [[span.start, span.end, replace_token] for span, replace_token in applied]
+        if self._history_level == "full":
+            self._history_dict["responses"] = responses
+
+        if self._history_writer is not None:
+            self._history_writer.write(self._history_dict)